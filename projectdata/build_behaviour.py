@@ -70,6 +70,9 @@ except ImportError:
     print "You need to update ohDevTools."
     sys.exit(1)
 
+# The go script runs from the top of the source tree.
+from wafmodules.publishing import read_content_hash, is_unchanged_since_published
+
 require_version(11)
 
 
@@ -129,6 +132,7 @@ def setup_universal(context):
     context.configure_args = get_dependency_args(ALL_DEPENDENCIES)
     version = context.options.publish_version or context.env.get("RELEASE_VERSION", "UNKNOWN")
     context.configure_args += ["--ohos-version", version]
+    context.configure_args += ["--deterministic-archives"]
 
 # Extra Windows build configuration.
 @build_step()
@@ -193,7 +197,19 @@ def publish(context):
     filename = "ohos-{version}-{platform}.tar.gz".format(platform=platform, version=version)
     sourcepath = os.path.join(builddir, "ohos.tar.gz")
     targetpath = publishdir + '/' + filename
+    # Each upload for a platform also replaces this sidecar, whatever its
+    # version, so it holds the hash of the last archive published.
+    latest_hash_path = publishdir + '/' + "ohos-latest-{platform}.tar.gz.sha256".format(platform=platform)
+    # The archive is reproducible, so if its hash matches the last one
+    # published for this platform, there's nothing new to upload.
+    content_hash = read_content_hash(sourcepath + ".sha256")
+    if is_unchanged_since_published(content_hash, latest_hash_path):
+        print "{0} is unchanged since the last archive for {1} was published, not uploading.".format(filename, platform)
+        return
     scp(sourcepath, targetpath)
+    if content_hash is not None:
+        scp(sourcepath + ".sha256", targetpath + ".sha256")
+        scp(sourcepath + ".sha256", latest_hash_path)
 
 def run_tests_remotely(env):
     username = "root"
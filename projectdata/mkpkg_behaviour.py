@@ -14,6 +14,9 @@ except ImportError:
     print "You need to update ohDevTools."
     sys.exit(1)
 
+# The go script runs from the top of the source tree.
+from wafmodules.publishing import read_content_hash, is_unchanged_since_published
+
 arch_vars = ''
 output = ""
 ret = ''
@@ -118,6 +121,17 @@ def publish_build(context):
     repo = context.env["REPOSITORY"]
     version = context.env["PACKAGE_VERSION"]
 
+    # The package installs the same files as the reproducible
+    # ohos.tar.gz built alongside it. If that hasn't changed since the
+    # last package for this repository and architecture was published,
+    # don't upload and ingest an identical package again.
+    content_hash_path = os.path.join(context.env["BUILDDIR"], "ohos.tar.gz.sha256")
+    remote_content_hash_path = '%s@%s:/var/www/openhome/apt-repo/incoming/%s/ohos_%s.sha256' %(username, host, repo, context.arch_vars["arch"])
+    content_hash = read_content_hash(content_hash_path)
+    if is_unchanged_since_published(content_hash, remote_content_hash_path):
+        print "ohos is unchanged since it was last published, not publishing."
+        return
+
     rsync(
             '-avz',
             '../',
@@ -136,4 +150,6 @@ def publish_build(context):
     with SshSession(host, username) as ssh:
         ssh(cmd)
         ssh(publish_openhome)
+    if content_hash is not None:
+        scp(content_hash_path, remote_content_hash_path)
 
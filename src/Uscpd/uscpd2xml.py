@@ -1,4 +1,12 @@
+import os
+import re
 import sys
+import json
+import shlex
+import hashlib
+import tempfile
+import time
+from StringIO import StringIO
 from optparse import OptionParser
 
 description = "Translate uSCPD files to XML."
@@ -51,6 +59,13 @@ END = object()
 SIMPLE_OPERATORS = "()[]{}:;=,"
 EOS_TOKEN = ("OP", ";")
 
+class UscpdSyntaxError(Exception):
+    def __init__(self, reason, line, column, *args, **kwargs):
+        Exception.__init__(self, "line %s, column %s: %s" % (line, column, reason), *args, **kwargs)
+        self.reason = reason
+        self.line = line
+        self.column = column
+
 class StateMachine(object):
     """
     State machine.
@@ -76,10 +91,21 @@ class StateMachine(object):
         Receive a sequence of messages and change
         state accordingly.
         '''
+        self.feed(iterable)
+        self.close()
+    def feed(self, iterable):
+        '''
+        Receive some of the messages. May be called
+        repeatedly before close().
+        '''
         for msg in iterable:
             if self._state is END:
                 raise Exception("Too much input")
             self.step(msg)
+    def close(self):
+        '''
+        Signal the end of the messages.
+        '''
         if self._state is END:
             raise Exception("Too much input")
         self.step(None)
@@ -93,14 +119,34 @@ def dont_end(msg):
         raise Exception("Unexpected end of input")
 
 class LexMachine(StateMachine):
+    '''
+    Lexer. Calls tokeneater(kind, value) for each token. While
+    tokeneater runs, token_position is the (line, column) at which
+    the token started. At any other time, line and column give the
+    position of the next character to be read, or of the character
+    being rejected if an exception is raised.
+    '''
     def __init__(self, tokeneater):
         StateMachine.__init__(self)
         self.tokeneater=tokeneater
+        self.line = 1
+        self.column = 1
+        self.token_position = None
+    def step(self, msg):
+        StateMachine.step(self, msg)
+        if msg == "\n":
+            self.line += 1
+            self.column = 1
+        elif msg is not None:
+            self.column += 1
     def submachine(self, cls, msg, end_state=None):
         if end_state is None:
             end_state = self.start_state
+        self.token_position = (self.line, self.column)
         return cls(msg, end_state, self.tokeneater)
     def comment_state(self, msg):
+        if msg is None:
+            return END
         if msg == "\n":
             return self.start_state
         return self.comment_state
@@ -116,6 +162,7 @@ class LexMachine(StateMachine):
         if msg == '#':
             return self.comment_state
         if msg in SIMPLE_OPERATORS:
+            self.token_position = (self.line, self.column)
             self.tokeneater('OP', msg)
             return self.start_state
         if msg.isdigit() or msg in "-+":
@@ -177,17 +224,168 @@ class NumberMachine(SubLexMachine):
         raise Exception("Unexpected '%s'" % (msg,))
     def decimal_state(self, msg):
         if msg is None:
-            self.tokeneater('INT', int(self.s))
+            self.tokeneater('FLOAT', float(self.s))
             return self.end_state(msg)
         if msg.isdigit():
             self.s += msg
-        if msg == "Ee":
+            return self.decimal_state
+        if msg in "Ee":
             raise Exception("Exponents not supported.")
         if msg.isspace() or msg in SIMPLE_OPERATORS:
             self.tokeneater('FLOAT', float(self.s))
             return self.end_state(msg)
         raise Exception("Unexpected '%s'" % (msg,))
 
+# RegexLexer produces the same (kind, value) tokens as LexMachine, but
+# matches a whole token at a time with one compiled pattern instead of
+# calling a state method for every character.
+
+DELIMITER = r"(?=[\s()\[\]{}:;=,]|\Z)"
+
+TOKEN_PATTERN = re.compile(r"""
+    (?P<SPACE>\s+)
+  | (?P<COMMENT>\#[^\n]*(?:\n|\Z))
+  | (?P<STR>"(?:[^"\\]|\\["\\])*")
+  | (?P<SYMBOL>[A-Za-z$][A-Za-z0-9_.]*)""" + DELIMITER + r"""
+  | (?P<FLOAT>[-+]?[0-9]+\.[0-9]*|[-+]\.[0-9]+)""" + DELIMITER + r"""
+  | (?P<INT>[-+]?[0-9]+)""" + DELIMITER + r"""
+  | (?P<OP>[()\[\]{}:;=,])
+""", re.VERBOSE)
+
+ESCAPE_PATTERN = re.compile(r'\\(["\\])')
+
+# Matches of these kinds that run up to the end of the text fed so far
+# might continue in the next piece of text.
+OPEN_ENDED_KINDS = ('COMMENT', 'SYMBOL', 'INT', 'FLOAT')
+
+class RegexLexer(object):
+    """
+    Table-driven alternative to LexMachine, with the same interface:
+    construct with a tokeneater and call run() with the text to lex,
+    or feed() it in pieces and then call close(). Positions are
+    reported the same way as LexMachine.
+    """
+    def __init__(self, tokeneater):
+        self.tokeneater = tokeneater
+        self.line = 1
+        self.column = 1
+        self.token_position = None
+        self.pending = ''
+    def run(self, text):
+        self.feed(text)
+        self.close()
+    def feed(self, text):
+        self.pending += text
+        self._lex(final=False)
+    def close(self):
+        self._lex(final=True)
+    def _lex(self, final):
+        text = self.pending
+        tokeneater = self.tokeneater
+        match = TOKEN_PATTERN.match
+        position = 0
+        length = len(text)
+        line = self.line
+        # Offset in text of the start of the current line. Negative if the
+        # line started in text that was fed earlier.
+        line_start = 1 - self.column
+        try:
+            while position < length:
+                m = match(text, position)
+                if m is None:
+                    char = text[position]
+                    if not final and (char in '"#' or (char in '-+' and length - position <= 2)):
+                        break
+                    if char in '"#':
+                        raise Exception("Unexpected end of input")
+                    raise Exception("Unexpected '%s'" % (char,))
+                kind = m.lastgroup
+                end = m.end()
+                if not final and end == length and kind in OPEN_ENDED_KINDS and text[end-1] != '\n':
+                    break
+                if kind != 'SPACE' and kind != 'COMMENT':
+                    value = m.group(kind)
+                    if kind == 'STR':
+                        value = ESCAPE_PATTERN.sub(r'\1', value)
+                    elif kind == 'INT':
+                        value = int(value)
+                    elif kind == 'FLOAT':
+                        value = float(value)
+                    self.token_position = (line, position - line_start + 1)
+                    tokeneater(kind, value)
+                if kind == 'SPACE' or kind == 'COMMENT' or kind == 'STR':
+                    newlines = text.count('\n', position, end)
+                    if newlines:
+                        line += newlines
+                        line_start = text.rindex('\n', position, end) + 1
+                position = end
+        finally:
+            self.line = line
+            self.column = position - line_start + 1
+            self.pending = text[position:]
+
+LEXERS = {
+    'machine' : LexMachine,
+    'regex' : RegexLexer,
+}
+DEFAULT_LEXER = 'regex'
+
+def tokenize(text, lexer_class=RegexLexer):
+    '''
+    Return a list of the (kind, value) tokens in text.
+    '''
+    xs = []
+    def usetoken(kind, value):
+        xs.append((kind, value))
+    lexer = lexer_class(usetoken)
+    lexer.run(text)
+    return xs
+
+def itertokens(lines, lexer_class=RegexLexer):
+    '''
+    Lex a sequence of lines (e.g. a file object) as one continuous
+    text. Generates (kind, value, line, column) for each token, ending
+    with an EOF token. Only the tokens of one line are held at a time.
+    Lexing errors are raised as UscpdSyntaxError.
+    '''
+    pending = []
+    def usetoken(kind, value):
+        pending.append((kind, value) + lexer.token_position)
+    lexer = lexer_class(usetoken)
+    for text in lines:
+        try:
+            lexer.feed(text)
+        except Exception, e:
+            raise UscpdSyntaxError(str(e), lexer.line, lexer.column)
+        for token in pending:
+            yield token
+        del pending[:]
+    try:
+        lexer.close()
+    except Exception, e:
+        raise UscpdSyntaxError(str(e), lexer.line, lexer.column)
+    for token in pending:
+        yield token
+    yield ("EOF", "", lexer.line, lexer.column)
+
+def compare_lexers(lines):
+    '''
+    Lex each line with every lexer in LEXERS. Return a list of
+    (line number, {lexer name: tokens}) for the lines where they
+    disagree. A lexer that raises is recorded as producing None.
+    '''
+    mismatches = []
+    for lineno, line in enumerate(lines, 1):
+        results = {}
+        for name, lexer_class in LEXERS.items():
+            try:
+                results[name] = tokenize(line, lexer_class)
+            except Exception:
+                results[name] = None
+        if len(set(repr(tokens) for tokens in results.values())) > 1:
+            mismatches.append((lineno, results))
+    return mismatches
+
 ##########
 # Parser #
 ##########
@@ -205,7 +403,7 @@ def expect(expected, actual):
 def get_identifier(token):
     kind, value = token
     if kind != "SYMBOL":
-        raise Exception("Expected identifier, got %s.", token)
+        raise Exception("Expected identifier, got %s." % (token,))
     if value.startswith("$"):
         return "A_ARG_TYPE_" + value[1:]
     return value
@@ -213,15 +411,15 @@ def get_identifier(token):
 def get_string(token):
     kind, value = token
     if kind != "STR":
-        raise Exception("Expected string, got %s.", (token,))
+        raise Exception("Expected string, got %s." % (token,))
     return value[1:-1]
     
 
-def parse(line):
+def parse(line, lexer_class=RegexLexer):
     xs = []
     def usetoken(kind, value):
         xs.append((kind, value))
-    lexer = LexMachine(usetoken)
+    lexer = lexer_class(usetoken)
     lexer.run(line)
     xs.append(("EOL",""))
     return parsetokens(xs)
@@ -238,7 +436,7 @@ def parsetokens(tokens):
         return parseaction(tokens)
     if t1=="type":
         return parsevar(tokens, evented=False)
-    raise Exception("Expected 'var', 'action' or 'type', got '%s'", (t1,))
+    raise Exception("Expected 'var', 'action' or 'type', got '%s'" % (t1,))
 
 def parsestatement(tokens):
     token = tokens.next()
@@ -251,7 +449,7 @@ def parsestatement(tokens):
         return parseaction(tokens)
     if t1=="type":
         return parsevar(tokens, evented=False)
-    raise Exception("Expected 'var', 'action' or 'type', got '%s'", (t1,))
+    raise Exception("Expected 'var', 'action' or 'type', got '%s'" % (t1,))
 
 
 def parsevar(tokens, evented):
@@ -283,7 +481,7 @@ def parsevar(tokens, evented):
                 raise Exception("Expected string or number for default value, got %s." % ((kind, value),))
         next_token = tokens.next()
         if next_token!=EOS_TOKEN:
-            raise Exception("Expected end of line, got %s", next_token)
+            raise Exception("Expected end of line, got %s" % (next_token,))
         break
     return StateVar(identifier, vartype, evented, allowed_values, allowed_range, default_value)
 
@@ -347,29 +545,51 @@ def parseaction(tokens):
     retarg = Parameter(argname, "out", argtype, True)
     for i,arg in enumerate(arguments):
         if arg.direction=="out":
-            arguments = arguments[:i] + retarg + arguments[i:]
+            arguments = arguments[:i] + [retarg] + arguments[i:]
             break
     else:
         arguments.append(retarg)
     return Action(identifier, arguments)
 
-def parsefile(fileobj):
-    xs = []
-    def usetoken(kind, value):
-        xs.append((kind, value))
-    for line in fileobj:
-        lexer = LexMachine(usetoken)
-        lexer.run(line)
-    xs.append(("EOF",""))
+class TokenStream(object):
+    '''
+    Iterator over the (kind, value) tokens from itertokens. Remembers
+    the position of the last token returned, for error reporting.
+    '''
+    def __init__(self, positioned_tokens):
+        self._tokens = iter(positioned_tokens)
+        self.line = 1
+        self.column = 1
+    def __iter__(self):
+        return self
+    def next(self):
+        kind, value, self.line, self.column = self._tokens.next()
+        return (kind, value)
+
+def iterstatements(lines, lexer_class=RegexLexer):
+    '''
+    Parse a sequence of lines (e.g. a file object), generating a
+    StateVar or Action as soon as the ';' ending its statement has
+    been read. Raises UscpdSyntaxError on invalid input.
+    '''
+    tokens = TokenStream(itertokens(lines, lexer_class))
+    while True:
+        try:
+            parsed = parsestatement(tokens)
+        except UscpdSyntaxError:
+            raise
+        except StopIteration:
+            raise UscpdSyntaxError("Unexpected end of input", tokens.line, tokens.column)
+        except Exception, e:
+            raise UscpdSyntaxError(str(e), tokens.line, tokens.column)
+        if parsed is None:
+            return
+        yield parsed
 
+def parsefile(fileobj, lexer_class=RegexLexer):
     variables = []
     actions = []
-    fiter = iter(fileobj)
-    tokeniter = iter(xs)
-    while True:
-        parsed = parsestatement(tokeniter)
-        if parsed is None:
-            break
+    for parsed in iterstatements(fileobj, lexer_class):
         if isinstance(parsed, StateVar):
             variables.append(parsed)
         elif isinstance(parsed, Action):
@@ -407,6 +627,63 @@ class Parameter(object):
     def __repr__(self):
         return "Parameter(%s, %s, %s, %s)" % (self.name, self.direction, self.argtype, self.retval)
 
+# A model file is a compact JSON dump of the parsed service, so that other
+# tools can load the StateVars, Actions and Parameters without parsing the
+# uSCPD or the XML again. Bump MODEL_VERSION if the layout changes.
+
+MODEL_FORMAT = "uscpd-model"
+MODEL_VERSION = 1
+MODEL_EXTENSION = ".model.json"
+
+def model_filename(xml_filename):
+    '''
+    Name of the model file written next to an XML file.
+    '''
+    return os.path.splitext(xml_filename)[0] + MODEL_EXTENSION
+
+def model_to_string(variables, actions):
+    return json.dumps({
+            "format" : MODEL_FORMAT,
+            "version" : MODEL_VERSION,
+            "variables" : [
+                [v.name, v.vartype, v.evented, v.allowed_values, v.allowed_range, v.default_value]
+                for v in variables],
+            "actions" : [
+                [a.name, [[p.name, p.direction, p.argtype, p.retval] for p in a.parameters]]
+                for a in actions],
+        }, sort_keys=True, separators=(',',':')) + "\n"
+
+def _from_json(value):
+    # The json module gives us unicode, but the parser produces str.
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def load_model(infile):
+    '''
+    Read a model file written by model_to_string, returning
+    (variables, actions) as parsefile would.
+    '''
+    model = json.load(infile)
+    if model.get("format") != MODEL_FORMAT or model.get("version") != MODEL_VERSION:
+        raise ValueError("Unsupported model: format %s, version %s." % (model.get("format"), model.get("version")))
+    variables = [
+        StateVar(
+            _from_json(name),
+            _from_json(vartype),
+            evented,
+            None if allowed_values is None else [_from_json(av) for av in allowed_values],
+            None if allowed_range is None else tuple(allowed_range),
+            _from_json(default_value))
+        for name, vartype, evented, allowed_values, allowed_range, default_value in model["variables"]]
+    actions = [
+        Action(
+            _from_json(name),
+            [Parameter(_from_json(pname), _from_json(direction), _from_json(argtype), retval)
+                for pname, direction, argtype, retval in parameters])
+        for name, parameters in model["actions"]]
+    return variables, actions
+
 def print_scpd(variables, actions, outfile = None):
     if outfile is None:
         outfile = sys.stdout
@@ -450,15 +727,243 @@ def print_scpd(variables, actions, outfile = None):
     outfile.write("    </actionList>\n")
     outfile.write("</scpd>\n")
 
+#########
+# Cache #
+#########
+
+# The cache maps a hash of uscpd2xml.py itself plus an input file to the
+# XML generated from it. Entries are written atomically and their mtimes
+# are refreshed on every hit, so that several processes can share one
+# directory and the least recently used entries are evicted first.
+
+DEFAULT_CACHE_SIZE = 32 * 1024 * 1024
+# A temporary file younger than this may still be being written by
+# another process. Older ones were left by a process that died.
+TEMP_FILE_GRACE_SECONDS = 60 * 60
+
+_tool_version = None
+
+def tool_version():
+    '''
+    Hash of this script's source, so that any change to it invalidates
+    everything it has cached.
+    '''
+    global _tool_version
+    if _tool_version is None:
+        source = os.path.splitext(os.path.abspath(__file__))[0] + '.py'
+        with open(source, 'rb') as f:
+            _tool_version = hashlib.sha1(f.read()).hexdigest()
+    return _tool_version
+
+def cache_from_environment():
+    '''
+    Return the cache configured by $USCPD2XML_CACHE_DIR and
+    $USCPD2XML_CACHE_SIZE, or None if no cache directory is set.
+    '''
+    directory = os.environ.get("USCPD2XML_CACHE_DIR")
+    if directory is None:
+        return None
+    return ConversionCache(directory, int(os.environ.get("USCPD2XML_CACHE_SIZE", DEFAULT_CACHE_SIZE)))
+
+class ConversionCache(object):
+    def __init__(self, directory, max_size=DEFAULT_CACHE_SIZE):
+        self.directory = directory
+        self.max_size = max_size
+    def key_for_file(self, filename):
+        digest = hashlib.sha1(tool_version())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), ''):
+                digest.update(chunk)
+        return digest.hexdigest()
+    def _path(self, key, extension):
+        return os.path.join(self.directory, key + extension)
+    def get(self, key, extension='.xml'):
+        '''
+        Return the cached content for key, or None on a miss. Each key
+        can have one entry per extension.
+        '''
+        path = self._path(key, extension)
+        try:
+            with open(path, 'rb') as f:
+                content = f.read()
+            os.utime(path, None)
+        except (IOError, OSError):
+            # Missing, or evicted by another process since we opened it.
+            return None
+        return content
+    def put(self, key, extension, content):
+        if not os.path.isdir(self.directory):
+            try:
+                os.makedirs(self.directory)
+            except OSError:
+                if not os.path.isdir(self.directory):
+                    raise
+        fd, temppath = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(content)
+            # mkstemp creates the file readable only by us. Let other
+            # users sharing the cache read it.
+            os.chmod(temppath, 0o644)
+            os.rename(temppath, self._path(key, extension))
+        except OSError:
+            # On Windows, rename fails if another process has just
+            # stored the same entry. Either way, ours isn't needed.
+            try:
+                os.remove(temppath)
+            except OSError:
+                pass
+        self.evict()
+    def evict(self):
+        '''
+        Remove the least recently used entries until the cache fits in
+        max_size bytes. Temporary files that other processes may still be
+        writing are left alone.
+        '''
+        entries = []
+        total = 0
+        now = time.time()
+        for name in os.listdir(self.directory):
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            if name.endswith('.tmp') and now - st.st_mtime < TEMP_FILE_GRACE_SECONDS:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+            total += st.st_size
+        entries.sort()
+        for mtime, size, name in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+def scpd_to_string(variables, actions):
+    output = StringIO()
+    print_scpd(variables, actions, output)
+    return output.getvalue()
+
+def write_if_changed(filename, content):
+    '''
+    Write content to the file unless it already holds exactly that
+    content, so that unchanged outputs keep their timestamps.
+    Returns True if the file was written.
+    '''
+    try:
+        with open(filename, 'r') as f:
+            if f.read() == content:
+                return False
+    except IOError:
+        pass
+    with open(filename, 'w') as f:
+        f.write(content)
+    return True
+
+def read_manifest(fileobj):
+    '''
+    Read (input, output) pairs from a manifest file. Each line holds an
+    input path and an output path separated by whitespace. Paths may be
+    quoted. Blank lines and lines starting with '#' are ignored.
+    '''
+    pairs = []
+    for lineno, line in enumerate(fileobj, 1):
+        if line.strip() == '' or line.lstrip().startswith('#'):
+            continue
+        fields = shlex.split(line)
+        if len(fields) != 2:
+            raise ValueError("Manifest line %s: expected an input and an output path, got %s" % (lineno, fields))
+        pairs.append(tuple(fields))
+    return pairs
+
+def convert_to_strings(inputname, lexer_class=RegexLexer, cache=None, with_model=False):
+    '''
+    Return (xml, model) for a uSCPD file, from the cache if possible.
+    model is the text of the model file, or None unless with_model.
+    '''
+    if cache is not None:
+        key = cache.key_for_file(inputname)
+        xml = cache.get(key, '.xml')
+        model = cache.get(key, MODEL_EXTENSION) if with_model else None
+        if xml is not None and (model is not None or not with_model):
+            return xml, model
+    with open(inputname, 'r') as infile:
+        variables, actions = parsefile(infile, lexer_class)
+    xml = scpd_to_string(variables, actions)
+    model = model_to_string(variables, actions) if with_model else None
+    if cache is not None:
+        cache.put(key, '.xml', xml)
+        if with_model:
+            cache.put(key, MODEL_EXTENSION, model)
+    return xml, model
+
+def _write(outfile, content):
+    if isinstance(outfile, basestring):
+        return write_if_changed(outfile, content)
+    outfile.write(content)
+    return True
+
+def convert(infile, outfile, lexer_class=RegexLexer, cache=None, modelfile=None):
+    '''
+    Convert uSCPD to SCPD XML. infile and outfile can each be a filename
+    or a file object. An output file given by name is only rewritten if
+    its content changes. If modelfile (a filename or file object) is
+    given, the parsed model is written to it too, for load_model.
+    Returns True if the XML output was written.
+    '''
+    with_model = modelfile is not None
+    if isinstance(infile, basestring):
+        xml, model = convert_to_strings(infile, lexer_class, cache, with_model)
+    else:
+        variables, actions = parsefile(infile, lexer_class)
+        xml = scpd_to_string(variables, actions)
+        model = model_to_string(variables, actions) if with_model else None
+    written = _write(outfile, xml)
+    if with_model:
+        _write(modelfile, model)
+    return written
+
+def convert_batch(pairs, lexer_class=RegexLexer, cache=None, with_model=False):
+    '''
+    Convert each (input, output) pair of filenames, writing only the
+    outputs whose content has changed. With with_model, also write each
+    output's model file next to it. Carries on past files that fail to
+    parse. Returns (written, failures) where written is a list of output
+    filenames and failures is a list of (input, error).
+    '''
+    written = []
+    failures = []
+    for inputname, outputname in pairs:
+        try:
+            modelfile = model_filename(outputname) if with_model else None
+            if convert(inputname, outputname, lexer_class, cache, modelfile):
+                written.append(outputname)
+        except (IOError, UscpdSyntaxError), e:
+            failures.append((inputname, e))
+    return written, failures
+
 def parse_args():
     usage = (
         "\n"+
         "    %prog [options]\n"+
+        "    %prog [options] --batch INPUT OUTPUT [INPUT OUTPUT ...]\n"+
+        "    %prog [options] --manifest FILE\n"+
         "\n"+
-        "Convert a uSCPD file to SCPD XML.")
+        "Convert a uSCPD file to SCPD XML. In batch mode, convert many\n"+
+        "files in one go and only rewrite outputs that have changed.")
     parser = OptionParser(usage=usage)
     parser.add_option("-i", "--input", dest="input", action="store", default=None, help="Input uSCPD file. (Default = stdin)")
     parser.add_option("-o", "--output", dest="output", action="store", default=None, help="Output XML file. (Default = stdout)")
+    parser.add_option("--batch", dest="batch", action="store_true", default=False, help="Treat the arguments as pairs of input and output files.")
+    parser.add_option("-m", "--manifest", dest="manifest", action="store", default=None, help="Convert the pairs of input and output files listed in this file.")
+    parser.add_option("--model", dest="model", action="store_true", default=False, help="Also write the parsed model as JSON next to each output, named *%s." % MODEL_EXTENSION)
+    parser.add_option("--cache-dir", dest="cache_dir", action="store", default=os.environ.get("USCPD2XML_CACHE_DIR"), help="Directory for a cache of converted files, which may be shared between builds. (Default = $USCPD2XML_CACHE_DIR, or no cache)")
+    parser.add_option("--cache-size", dest="cache_size", action="store", type="int", default=int(os.environ.get("USCPD2XML_CACHE_SIZE", DEFAULT_CACHE_SIZE)), help="Maximum size of the cache in bytes. (Default = $USCPD2XML_CACHE_SIZE, or %s)" % DEFAULT_CACHE_SIZE)
+    parser.add_option("--lexer", dest="lexer", action="store", type="choice", choices=sorted(LEXERS.keys()), default=DEFAULT_LEXER, help="Lexer engine to use, one of %s. (Default = %s)" % (", ".join(sorted(LEXERS.keys())), DEFAULT_LEXER))
+    parser.add_option("--check-lexer", dest="check_lexer", action="store_true", default=False, help="Check that every lexer engine gives identical tokens for the input, instead of converting it.")
     parser.set_defaults(indent="", endings="")
     return parser.parse_args()
 
@@ -468,15 +973,46 @@ def main():
     Write SCPD XML file to stdout.
     '''
     options, args = parse_args()
+    cache = None if options.cache_dir is None else ConversionCache(options.cache_dir, options.cache_size)
+    if options.batch or options.manifest is not None:
+        if len(args) % 2 != 0:
+            print "Usage:"
+            print "    uscpd2xml --batch input1.uscpd output1.xml input2.uscpd output2.xml ..."
+            sys.exit(1)
+        pairs = zip(args[0::2], args[1::2])
+        if options.manifest is not None:
+            with open(options.manifest, 'r') as manifest:
+                pairs.extend(read_manifest(manifest))
+        written, failures = convert_batch(pairs, LEXERS[options.lexer], cache, options.model)
+        for inputname, error in failures:
+            print >>sys.stderr, "%s: %s" % (inputname, error)
+        sys.exit(1 if failures else 0)
     if len(args)>0:
         print "Usage:"
         print "    uscpd2xml < input.uscpd > output.xml"
         sys.exit(1)
 
-    infile = sys.stdin if options.input is None else file(options.input, 'r')
-    outfile = sys.stdout if options.output is None else file(options.output, 'w')
-    a,b = parsefile(infile)
-    print_scpd(a,b,outfile)
+    if options.check_lexer:
+        infile = sys.stdin if options.input is None else file(options.input, 'r')
+        mismatches = compare_lexers(infile)
+        for lineno, results in mismatches:
+            print "Line %s:" % (lineno,)
+            for name, tokens in sorted(results.items()):
+                print "    %s: %s" % (name, "error" if tokens is None else tokens)
+        sys.exit(1 if mismatches else 0)
+    if options.model and options.output is None:
+        print "--model requires an output file."
+        sys.exit(1)
+    try:
+        convert(
+                sys.stdin if options.input is None else options.input,
+                sys.stdout if options.output is None else options.output,
+                LEXERS[options.lexer],
+                cache,
+                model_filename(options.output) if options.model else None)
+    except UscpdSyntaxError, e:
+        print >>sys.stderr, "%s: %s" % ("<stdin>" if options.input is None else options.input, e)
+        sys.exit(1)
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,300 @@
+import os
+import sys
+import json
+import time
+import platform
+import multiprocessing
+from StringIO import StringIO
+from optparse import OptionParser
+
+import uscpd2xml
+
+description = "Benchmark the uSCPD lexer, parser and XML writer."
+command_group = "Developer tools"
+
+RESULTS_FORMAT = "uscpd-bench"
+RESULTS_VERSION = 1
+
+##########
+# Corpus #
+##########
+
+# Each generator returns a list of lines that parse as a valid service.
+# The sizes are multiplied by --scale, so the same shapes can be timed
+# at several sizes to see how each phase scales.
+
+VAR_FORMS = [
+    'var Volume%(n)s : ui4 [0:100:1] = 50;\n',
+    'var Name%(n)s : string = "Unnamed service %(n)s";\n',
+    'type $Flavour%(n)s : string ["vanilla", "chocolate", "strawberry"];\n',
+    'type $Gain%(n)s : i4 [-1000:1000];\n',
+    'var Ratio%(n)s : r8 = -0.25;\n',
+    'type $Uri%(n)s : uri;\n',
+]
+
+def many_vars(scale):
+    '''
+    Thousands of var and type declarations of every form, and a few
+    actions that use them.
+    '''
+    count = 5000 * scale
+    lines = [VAR_FORMS[n % len(VAR_FORMS)] % {'n': n} for n in xrange(count)]
+    for n in xrange(0, count, 100):
+        lines.append('action GetVolume%s(Volume : out Volume%s);\n' % (n, n))
+    return lines
+
+def wide_actions(scale):
+    '''
+    Actions with hundreds of arguments, one argument per line, each
+    ending in a return value.
+    '''
+    lines = [
+        'type $Count : ui4;\n',
+        'type $Text : string;\n',
+    ]
+    for n in xrange(50 * scale):
+        lines.append('action Wide%s(\n' % (n,))
+        lines.extend(
+            '    Arg%s : %s %s,\n' % (i, "in" if i % 2 else "out", "$Count" if i % 3 else "$Text")
+            for i in xrange(299))
+        lines.append('    Arg299 : in $Text) = Result : $Count;\n')
+    return lines
+
+def long_allowed_values(scale):
+    '''
+    String variables with very long allowed value lists, including
+    escaped quotes.
+    '''
+    lines = []
+    for n in xrange(20 * scale):
+        values = ', '.join('"Value \\"%s\\" of list %s"' % (i, n) for i in xrange(1000))
+        lines.append('type $Choice%s : string [%s];\n' % (n, values))
+    lines.append('action Choose(Choice : in $Choice0);\n')
+    return lines
+
+def comment_heavy(scale):
+    '''
+    A small service buried in comments: ten comment lines for every
+    statement, and trailing comments on the statements themselves.
+    '''
+    lines = []
+    for n in xrange(1000 * scale):
+        lines.extend(
+            '# Comment %s about statement %s: "quotes", [brackets] and ; semicolons.\n' % (i, n)
+            for i in xrange(10))
+        lines.append('var Value%s : i4 = %s; # trailing comment\n' % (n, n))
+    return lines
+
+CORPORA = [
+    ('many_vars', many_vars),
+    ('wide_actions', wide_actions),
+    ('long_allowed_values', long_allowed_values),
+    ('comment_heavy', comment_heavy),
+]
+
+##########
+# Phases #
+##########
+
+# Each phase works on the output of the one before, which is prepared
+# outside the timed section, so that the time reported for parsing
+# doesn't include lexing and so on. Every phase returns the number of
+# items it produced, which is what its rate is measured in.
+
+def phase_lex(lines, lexer_class):
+    count = 0
+    for token in uscpd2xml.itertokens(lines, lexer_class):
+        count += 1
+    return count
+
+def phase_parse(tokens):
+    stream = uscpd2xml.TokenStream(tokens)
+    count = 0
+    while uscpd2xml.parsestatement(stream) is not None:
+        count += 1
+    return count
+
+def phase_print(variables, actions):
+    outfile = StringIO()
+    uscpd2xml.print_scpd(variables, actions, outfile)
+    return len(outfile.getvalue())
+
+PHASES = [
+    # (name, unit of the items counted)
+    ('lex', 'tokens'),
+    ('parse', 'statements'),
+    ('print_scpd', 'bytes'),
+]
+
+def max_rss_kb():
+    '''
+    Peak resident set size of this process so far, in KB.
+    '''
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # Reported in bytes rather than KB.
+        rss //= 1024
+    return rss
+
+def run_phase(job):
+    '''
+    Time one phase on one corpus, best of repeat runs. job is
+    (corpus name, scale, lexer name, phase name, repeat). Runs in a
+    fresh worker process so that the peak memory reported belongs to
+    this phase alone.
+    '''
+    corpus_name, scale, lexer_name, phase, repeat = job
+    lexer_class = uscpd2xml.LEXERS[lexer_name]
+    lines = dict(CORPORA)[corpus_name](scale)
+    if phase == 'lex':
+        func, args = phase_lex, (lines, lexer_class)
+    else:
+        tokens = list(uscpd2xml.itertokens(lines, lexer_class))
+        if phase == 'parse':
+            func, args = phase_parse, (tokens,)
+        else:
+            variables, actions = uscpd2xml.parsefile(lines, lexer_class)
+            func, args = phase_print, (variables, actions)
+    baseline_rss = max_rss_kb()
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        items = func(*args)
+        seconds = time.time() - start
+        if best is None or seconds < best:
+            best = seconds
+    peak_rss = max_rss_kb()
+    return {
+        'corpus' : corpus_name,
+        'scale' : scale,
+        'input_bytes' : sum(len(line) for line in lines),
+        'lexer' : lexer_name,
+        'phase' : phase,
+        'seconds' : best,
+        'items' : items,
+        'unit' : dict(PHASES)[phase],
+        'items_per_second' : items / max(best, 1e-9),
+        'peak_rss_kb' : peak_rss,
+        'peak_rss_growth_kb' : peak_rss - baseline_rss,
+    }
+
+def run_benchmarks(corpus_names, lexer_names, scale=1, repeat=3):
+    '''
+    Run every phase for every combination of corpus and lexer. Returns
+    a list of result dicts, one per phase run.
+    '''
+    jobs = [
+        (corpus_name, scale, lexer_name, phase, repeat)
+        for corpus_name in corpus_names
+        for lexer_name in lexer_names
+        for phase, unit in PHASES]
+    results = []
+    for job in jobs:
+        pool = multiprocessing.Pool(1)
+        try:
+            results.append(pool.apply(run_phase, (job,)))
+        finally:
+            pool.close()
+            pool.join()
+    return results
+
+###########
+# Results #
+###########
+
+def result_key(result):
+    return (result['corpus'], result['scale'], result['lexer'], result['phase'])
+
+def results_to_string(results):
+    return json.dumps({
+            'format' : RESULTS_FORMAT,
+            'version' : RESULTS_VERSION,
+            'tool_version' : uscpd2xml.tool_version(),
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'results' : results,
+        }, indent=1, sort_keys=True) + "\n"
+
+def load_results(infile):
+    document = json.load(infile)
+    if document.get('format') != RESULTS_FORMAT or document.get('version') != RESULTS_VERSION:
+        raise Exception("Not a %s version %s results file." % (RESULTS_FORMAT, RESULTS_VERSION))
+    return document['results']
+
+def find_regressions(baseline, results, max_slowdown):
+    '''
+    Compare results with the baseline results of an earlier run.
+    Returns (result, baseline result) for every phase that has become
+    more than max_slowdown times slower.
+    '''
+    baseline_by_key = dict((result_key(r), r) for r in baseline)
+    regressions = []
+    for result in results:
+        old = baseline_by_key.get(result_key(result))
+        if old is None:
+            continue
+        if result['items_per_second'] * max_slowdown < old['items_per_second']:
+            regressions.append((result, old))
+    return regressions
+
+def print_results(results, outfile=None):
+    if outfile is None:
+        outfile = sys.stdout
+    outfile.write("%-20s %-8s %-11s %9s %24s %12s %12s\n" % (
+        "corpus", "lexer", "phase", "seconds", "rate", "peak KB", "growth KB"))
+    for r in results:
+        outfile.write("%-20s %-8s %-11s %9.3f %24s %12s %12s\n" % (
+            r['corpus'], r['lexer'], r['phase'], r['seconds'],
+            "%.0f %s/s" % (r['items_per_second'], r['unit']),
+            r['peak_rss_kb'], r['peak_rss_growth_kb']))
+
+def parse_args():
+    corpus_names = [name for (name, generator) in CORPORA]
+    usage = (
+        "\n"+
+        "    %prog [options]\n"+
+        "\n"+
+        "Generate synthetic uSCPD services and time lexing, parsing and\n"+
+        "XML output separately for each of them.")
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--output", dest="output", action="store", default=None, help="Write the results as JSON to this file.")
+    parser.add_option("--corpus", dest="corpora", action="append", type="choice", choices=corpus_names, default=None, help="Corpus to run, one of %s. May be given more than once. (Default = all)" % (", ".join(corpus_names),))
+    parser.add_option("--lexer", dest="lexers", action="append", type="choice", choices=sorted(uscpd2xml.LEXERS.keys()), default=None, help="Lexer to use, one of %s. May be given more than once. (Default = all)" % (", ".join(sorted(uscpd2xml.LEXERS.keys())),))
+    parser.add_option("--scale", dest="scale", action="store", type="int", default=1, help="Multiply the size of every corpus by this. (Default = 1)")
+    parser.add_option("--repeat", dest="repeat", action="store", type="int", default=3, help="Time each phase this many times and report the fastest. (Default = 3)")
+    parser.add_option("--baseline", dest="baseline", action="store", default=None, help="Results file from an earlier run to compare against.")
+    parser.add_option("--max-slowdown", dest="max_slowdown", action="store", type="float", default=1.5, help="With --baseline, fail if any phase is this many times slower. (Default = 1.5)")
+    return parser.parse_args()
+
+def main():
+    '''
+    Run the benchmarks, print a table of the results and optionally
+    write them to a file. Exits with status 1 if a phase has regressed
+    against the --baseline results.
+    '''
+    options, args = parse_args()
+    if len(args) > 0 or options.scale < 1 or options.repeat < 1:
+        print "Usage:"
+        print "    uscpdbench [-o results.json] [--baseline old.json]"
+        sys.exit(0)
+    corpus_names = options.corpora or [name for (name, generator) in CORPORA]
+    lexer_names = options.lexers or sorted(uscpd2xml.LEXERS.keys())
+    results = run_benchmarks(corpus_names, lexer_names, options.scale, options.repeat)
+    print_results(results)
+    if options.output is not None:
+        with open(options.output, "w") as outfile:
+            outfile.write(results_to_string(results))
+    if options.baseline is not None:
+        with open(options.baseline) as infile:
+            baseline = load_results(infile)
+        regressions = find_regressions(baseline, results, options.max_slowdown)
+        for result, old in regressions:
+            print "Regression: %s/%s/%s %.0f %s/s, was %.0f." % (
+                result['corpus'], result['lexer'], result['phase'],
+                result['items_per_second'], result['unit'], old['items_per_second'])
+        if regressions:
+            sys.exit(1)
+
+if __name__=="__main__":
+    main()
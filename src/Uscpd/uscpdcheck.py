@@ -0,0 +1,206 @@
+import os
+import sys
+import glob
+import shutil
+import tempfile
+from StringIO import StringIO
+from optparse import OptionParser
+
+import uscpd2xml
+import uscpdbench
+
+description = "Check uscpd2xml's lexer, parser, batch mode and cache against the original line-by-line parser."
+command_group = "Developer tools"
+
+SERVICE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'ServiceXml', 'Uscpd')
+
+class CheckFailed(Exception):
+    pass
+
+def check_equal(what, expected, actual):
+    if expected != actual:
+        raise CheckFailed("%s differ." % (what,))
+
+##########################
+# The original converter #
+##########################
+
+# What uscpd2xml did before the regex lexer and the streaming parser:
+# lex each line separately with LexMachine, then parse the whole list of
+# tokens.
+
+def original_tokens(lines):
+    tokens = []
+    for line in lines:
+        tokens.extend(uscpd2xml.tokenize(line, uscpd2xml.LexMachine))
+    return tokens
+
+def original_parsefile(lines):
+    tokeniter = iter(original_tokens(lines) + [("EOF","")])
+    variables = []
+    actions = []
+    while True:
+        parsed = uscpd2xml.parsestatement(tokeniter)
+        if parsed is None:
+            break
+        if isinstance(parsed, uscpd2xml.StateVar):
+            variables.append(parsed)
+        elif isinstance(parsed, uscpd2xml.Action):
+            actions.append(parsed)
+    return variables, actions
+
+##########
+# Checks #
+##########
+
+# Each check takes the lines of one service and raises CheckFailed if
+# the code under test disagrees with the original converter.
+
+def check_lexers(lines):
+    expected = original_tokens(lines)
+    for name, lexer_class in sorted(uscpd2xml.LEXERS.items()):
+        tokens = [(kind, value) for (kind, value, line, column) in uscpd2xml.itertokens(lines, lexer_class)]
+        check_equal("Tokens from the %s lexer" % (name,), expected + [("EOF","")], tokens)
+
+def check_parser(lines):
+    expected = uscpd2xml.scpd_to_string(*original_parsefile(lines))
+    for name, lexer_class in sorted(uscpd2xml.LEXERS.items()):
+        actual = uscpd2xml.scpd_to_string(*uscpd2xml.parsefile(lines, lexer_class))
+        check_equal("XML from the streaming parser with the %s lexer" % (name,), expected, actual)
+
+def check_model(lines):
+    variables, actions = uscpd2xml.parsefile(lines)
+    model = uscpd2xml.model_to_string(variables, actions)
+    check_equal(
+            "XML from the model and from the parser",
+            uscpd2xml.scpd_to_string(variables, actions),
+            uscpd2xml.scpd_to_string(*uscpd2xml.load_model(StringIO(model))))
+
+LINE_CHECKS = [
+    ('lexer', check_lexers),
+    ('parser', check_parser),
+    ('model', check_model),
+]
+
+def check_batch_and_cache(services, tempdir):
+    '''
+    Convert all the services in one batch, twice, sharing a cache. Both
+    runs must write what the original converter wrote, the second from
+    the cache.
+    '''
+    inputdir = os.path.join(tempdir, 'in')
+    os.makedirs(inputdir)
+    cache = uscpd2xml.ConversionCache(os.path.join(tempdir, 'cache'), 1024 * 1024 * 1024)
+    pairs = []
+    expected = {}
+    for name, lines in services:
+        inputname = os.path.join(inputdir, name + '.uscpd')
+        with open(inputname, 'w') as f:
+            f.writelines(lines)
+        outputname = os.path.join(tempdir, name + '.xml')
+        pairs.append((inputname, outputname))
+        expected[outputname] = uscpd2xml.scpd_to_string(*original_parsefile(lines))
+    for run in ['first', 'second']:
+        for inputname, outputname in pairs:
+            if os.path.exists(outputname):
+                os.remove(outputname)
+        written, failures = uscpd2xml.convert_batch(pairs, cache=cache, with_model=True)
+        if failures:
+            raise CheckFailed("The %s batch failed: %s" % (run, failures))
+        for inputname, outputname in pairs:
+            with open(outputname) as f:
+                check_equal("XML from the %s batch for %s" % (run, inputname), expected[outputname], f.read())
+            with open(uscpd2xml.model_filename(outputname)) as f:
+                check_equal(
+                        "XML from the %s batch's model for %s" % (run, inputname),
+                        expected[outputname],
+                        uscpd2xml.scpd_to_string(*uscpd2xml.load_model(f)))
+        for inputname, outputname in pairs:
+            if cache.get(cache.key_for_file(inputname)) != expected[outputname]:
+                raise CheckFailed("The cache doesn't hold the XML for %s after the %s batch." % (inputname, run))
+
+def check_eviction(tempdir):
+    '''
+    Eviction removes the oldest entries, but not a temporary file that
+    another process may still be writing.
+    '''
+    directory = os.path.join(tempdir, 'evict')
+    cache = uscpd2xml.ConversionCache(directory, 100)
+    os.makedirs(directory)
+    with open(os.path.join(directory, 'writing.tmp'), 'wb') as f:
+        f.write('x' * 1000)
+    cache.put('old', '.xml', 'o' * 60)
+    old_time = os.stat(os.path.join(directory, 'old.xml')).st_mtime - 10
+    os.utime(os.path.join(directory, 'old.xml'), (old_time, old_time))
+    cache.put('new', '.xml', 'n' * 60)
+    check_equal("Files left by eviction", ['new.xml', 'writing.tmp'], sorted(os.listdir(directory)))
+
+############
+# Services #
+############
+
+def get_services(filenames, scale):
+    '''
+    (name, lines) for the generated benchmark corpora, the services in
+    the source tree and any other files given.
+    '''
+    services = [(name, generator(scale)) for (name, generator) in uscpdbench.CORPORA]
+    for filename in sorted(glob.glob(os.path.join(SERVICE_DIR, '*', '*.uscpd'))) + filenames:
+        with open(filename) as f:
+            services.append((os.path.splitext(os.path.basename(filename))[0], f.readlines()))
+    return services
+
+def run_checks(services):
+    '''
+    Run every check, printing a line for each. Returns the number that
+    failed.
+    '''
+    failed = 0
+    def run(name, check, *args):
+        try:
+            check(*args)
+        except CheckFailed, e:
+            print "FAIL %s: %s" % (name, e)
+            return 1
+        print "ok   %s" % (name,)
+        return 0
+    for service_name, lines in services:
+        for check_name, check in LINE_CHECKS:
+            failed += run("%s %s" % (check_name, service_name), check, lines)
+    tempdir = tempfile.mkdtemp(prefix='uscpdcheck')
+    try:
+        failed += run("batch and cache", check_batch_and_cache, services, tempdir)
+        failed += run("cache eviction", check_eviction, tempdir)
+    finally:
+        shutil.rmtree(tempdir)
+    return failed
+
+def parse_args():
+    usage = (
+        "\n"+
+        "    %prog [options] [FILE.uscpd...]\n"+
+        "\n"+
+        "Check that the lexers, the streaming parser, the model files, batch\n"+
+        "mode and the cache all give the same XML as the original\n"+
+        "line-by-line converter, for the benchmark corpora, the services in\n"+
+        "the source tree and any other files given.")
+    parser = OptionParser(usage=usage)
+    parser.add_option("--scale", dest="scale", action="store", type="int", default=1, help="Multiply the size of every generated corpus by this. (Default = 1)")
+    return parser.parse_args()
+
+def main():
+    '''
+    Run the checks. Exits with status 1 if any failed.
+    '''
+    options, args = parse_args()
+    if options.scale < 1:
+        print "Usage:"
+        print "    uscpdcheck [--scale N] [FILE.uscpd...]"
+        sys.exit(0)
+    failed = run_checks(get_services(args, options.scale))
+    if failed:
+        print "%s checks failed." % (failed,)
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -1,5 +1,13 @@
 from xml.etree.ElementTree import parse
+import os
 import sys
+import time
+import multiprocessing
+from optparse import OptionParser
+try:
+    from xml.etree.cElementTree import iterparse
+except ImportError:
+    from xml.etree.ElementTree import iterparse
 
 description = "Translate XML files to uSCPD."
 command_group = "Developer tools"
@@ -38,71 +46,246 @@ def value_to_identifier(value):
         return "$"+value[len("A_ARG_TYPE_"):]
     return value
 
+def local_name(tag):
+    '''
+    Strip the namespace, if any, from an element's tag. Real SCPD
+    documents put everything in the UPnP service namespace.
+    '''
+    if tag.startswith("{"):
+        return tag[tag.index("}")+1:]
+    return tag
+
+def find_child(element, name):
+    for child in element:
+        if local_name(child.tag) == name:
+            return child
+    return None
+
+def find_child_text(element, name):
+    child = find_child(element, name)
+    if child is None:
+        return None
+    return child.text or ""
+
+def state_variable_to_text(var):
+    name = find_child_text(var, "name")
+    evented = find_child_text(var, "sendEventsAttribute")
+    datatype = find_child_text(var, "dataType")
+    allowedvaluelist = find_child(var, "allowedValueList")
+    if allowedvaluelist is not None:
+        allowedvalues = list(v.text for v in allowedvaluelist)
+    else:
+        allowedvalues = None
+    allowedvaluerange = find_child(var, "allowedValueRange")
+    if allowedvaluerange is not None:
+        allowedrange = (
+                find_child_text(allowedvaluerange, "minimum"),
+                find_child_text(allowedvaluerange, "maximum"),
+                find_child_text(allowedvaluerange, "step"))
+    else:
+        allowedrange = None
+    defaultvalue = find_child_text(var, "defaultValue")
+
+    tag = "var" if evented=="yes" else "type"
+    identifier = value_to_identifier(name)
+    rangetext = range_to_text(allowedrange)
+    valuestext = values_to_text(allowedvalues)
+    defaulttext = (
+            None if defaultvalue is None else
+            "= " + value_to_literal(defaultvalue, datatype))
+    tokens = [tag, identifier, ":", datatype, rangetext, valuestext, defaulttext]
+    return " ".join(t for t in tokens if t is not None) + ";\n"
+
+def action_to_text(action):
+    name = find_child_text(action, "name")
+    argumentlist = find_child(action, "argumentList")
+    if argumentlist is None:
+        argumentlist = []
+    argstrings = []
+    retargstring = ""
+    for a in argumentlist:
+        argname = find_child_text(a, "name")
+        argdirection = find_child_text(a, "direction")
+        argvar = find_child_text(a, "relatedStateVariable")
+        argretval = find_child(a, "retval") is not None
+        argstring = "%s : %s %s" % (value_to_identifier(argname), argdirection, value_to_identifier(argvar))
+        if argretval:
+            retargstring = "= " + argstring
+        else:
+            argstrings.append(argstring)
+    return "action %s(%s)%s;\n" % (
+            name,
+            ", ".join(argstrings),
+            retargstring)
+
 def transform(infile, outfile):
-    etree = parse(infile)
-    state_vars = etree.find("serviceStateTable")
+    root = parse(infile).getroot()
+    state_vars = find_child(root, "serviceStateTable")
     for var in state_vars:
-        name = var.findtext("name")
-        evented = var.findtext("sendEventsAttribute")
-        datatype = var.findtext("dataType")
-        allowedvaluelist = var.find("allowedValueList")
-        if allowedvaluelist is not None:
-            allowedvalues = list(v.text for v in allowedvaluelist)
-        else:
-            allowedvalues = None
-        allowedvaluerange = var.find("allowedValueRange")
-        if allowedvaluerange is not None:
-            allowedrange = (
-                    allowedvaluerange.findtext("minimum"),
-                    allowedvaluerange.findtext("maximum"),
-                    allowedvaluerange.findtext("step"))
-        else:
-            allowedrange = None
-        defaultvalue = var.findtext("defaultValue")
-
-        tag = "var" if evented=="yes" else "type"
-        identifier = value_to_identifier(name)
-        rangetext = range_to_text(allowedrange)
-        valuestext = values_to_text(allowedvalues)
-        defaulttext = (
-                None if defaultvalue is None else
-                "= " + value_to_literal(defaultvalue, datatype))
-        tokens = [tag, identifier, ":", datatype, rangetext, valuestext, defaulttext]
-        outfile.write(" ".join(t for t in tokens if t is not None) + ";\n")
-
-    actions = etree.find("actionList")
+        outfile.write(state_variable_to_text(var))
+    actions = find_child(root, "actionList")
     for action in actions:
-        name = action.findtext("name")
-        argumentlist = action.find("argumentList")
-        if argumentlist is None:
-            argumentlist = []
-        argstrings = []
-        retargstring = ""
-        for a in argumentlist:
-            argname = a.findtext("name")
-            argdirection = a.findtext("direction")
-            argvar = a.findtext("relatedStateVariable")
-            argretval = a.find("retval") is not None
-            argstring = "%s : %s %s" % (value_to_identifier(argname), argdirection, value_to_identifier(argvar))
-            if argretval:
-                retargstring = "= " + argstring
-            else:
-                argstrings.append(argstring)
-        outfile.write("action %s(%s)%s;\n" % (
-                name,
-                ", ".join(argstrings),
-                retargstring))
+        outfile.write(action_to_text(action))
+
+def transform_iterparse(infile, outfile):
+    '''
+    Same output as transform, but writes each line as soon as its
+    element has been read and then discards the element, so memory
+    doesn't grow with the size of the document. Action lines are held
+    back only while waiting for a serviceStateTable that comes after
+    the actionList, because variables are always written first.
+    '''
+    stack = []
+    seen_state_table = False
+    held_actions = []
+    for event, element in iterparse(infile, events=("start", "end")):
+        if event == "start":
+            stack.append(element)
+            continue
+        stack.pop()
+        depth = len(stack)
+        if depth == 2:
+            section = local_name(stack[1].tag)
+            if section == "serviceStateTable":
+                outfile.write(state_variable_to_text(element))
+            elif section == "actionList":
+                line = action_to_text(element)
+                if seen_state_table:
+                    outfile.write(line)
+                else:
+                    held_actions.append(line)
+            stack[1].remove(element)
+        elif depth == 1:
+            if local_name(element.tag) == "serviceStateTable":
+                seen_state_table = True
+                outfile.writelines(held_actions)
+                del held_actions[:]
+            stack[0].remove(element)
+    outfile.writelines(held_actions)
+
+ENGINES = {
+    'tree' : transform,
+    'iterparse' : transform_iterparse,
+}
+DEFAULT_ENGINE = 'iterparse'
+
+def convert_file(job):
+    '''
+    Convert one XML file to uSCPD. job is (inputname, outputname, engine).
+    Returns (inputname, input size in bytes, error message or None).
+    Runs in the worker processes of convert_directory.
+    '''
+    inputname, outputname, engine = job
+    try:
+        size = os.path.getsize(inputname)
+        outputdir = os.path.dirname(outputname)
+        if outputdir and not os.path.isdir(outputdir):
+            try:
+                os.makedirs(outputdir)
+            except OSError:
+                # Another worker may have just created it.
+                if not os.path.isdir(outputdir):
+                    raise
+        with open(inputname, 'rb') as infile:
+            with open(outputname, 'w') as outfile:
+                ENGINES[engine](infile, outfile)
+    except Exception, e:
+        # Don't leave a partial output behind.
+        if os.path.isfile(outputname):
+            os.remove(outputname)
+        return (inputname, 0, "%s: %s" % (e.__class__.__name__, e))
+    return (inputname, size, None)
+
+def find_xml_files(inputdir, outputdir):
+    '''
+    List (inputname, outputname) for every .xml file under inputdir,
+    mirroring the directory structure under outputdir.
+    '''
+    pairs = []
+    for dirpath, dirnames, filenames in os.walk(inputdir):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if not filename.lower().endswith(".xml"):
+                continue
+            inputname = os.path.join(dirpath, filename)
+            relative = os.path.relpath(inputname, inputdir)
+            pairs.append((inputname, os.path.join(outputdir, os.path.splitext(relative)[0] + ".uscpd")))
+    return pairs
+
+def convert_directory(inputdir, outputdir, engine=DEFAULT_ENGINE, processes=None):
+    '''
+    Convert every .xml file under inputdir to a .uscpd file under
+    outputdir using a pool of worker processes. Returns a dict
+    summarising the run: files, bytes, seconds and failures, a list of
+    (inputname, error message).
+    '''
+    jobs = [(inputname, outputname, engine) for (inputname, outputname) in find_xml_files(inputdir, outputdir)]
+    start = time.time()
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(convert_file, jobs, chunksize=max(1, len(jobs) // (4 * (processes or multiprocessing.cpu_count()))))
+    finally:
+        pool.close()
+        pool.join()
+    seconds = time.time() - start
+    return {
+        'files' : len(jobs),
+        'bytes' : sum(size for (inputname, size, error) in results),
+        'seconds' : seconds,
+        'failures' : [(inputname, error) for (inputname, size, error) in results if error is not None],
+    }
+
+def print_summary(summary, outfile=None):
+    if outfile is None:
+        outfile = sys.stdout
+    seconds = max(summary['seconds'], 1e-6)
+    failures = summary['failures']
+    converted = summary['files'] - len(failures)
+    # Rates count only the files that were converted: a file that fails
+    # early would otherwise make the run look faster.
+    outfile.write("Converted %s of %s files (%.1f KB) in %.2fs: %.1f files/s, %.1f KB/s.\n" % (
+        converted,
+        summary['files'],
+        summary['bytes'] / 1024.0,
+        summary['seconds'],
+        converted / seconds,
+        summary['bytes'] / 1024.0 / seconds))
+    if failures:
+        outfile.write("%s of %s files failed:\n" % (len(failures), summary['files']))
+        for inputname, error in failures:
+            outfile.write("    %s: %s\n" % (inputname, error))
+
+def parse_args():
+    usage = (
+        "\n"+
+        "    %prog [options] < input.xml > output.uscpd\n"+
+        "    %prog [options] --dir INPUTDIR --out OUTPUTDIR\n"+
+        "\n"+
+        "Convert SCPD XML to uSCPD. With --dir, convert every .xml file\n"+
+        "under INPUTDIR in parallel and write a summary.")
+    parser = OptionParser(usage=usage)
+    parser.add_option("--dir", dest="dir", action="store", default=None, help="Directory tree of XML files to convert.")
+    parser.add_option("--out", dest="out", action="store", default=None, help="Directory to write uSCPD files to, with --dir.")
+    parser.add_option("-j", "--jobs", dest="jobs", action="store", type="int", default=None, help="Number of worker processes, with --dir. (Default = number of CPUs)")
+    parser.add_option("--engine", dest="engine", action="store", type="choice", choices=sorted(ENGINES.keys()), default=DEFAULT_ENGINE, help="XML reader to use, one of %s. (Default = %s)" % (", ".join(sorted(ENGINES.keys())), DEFAULT_ENGINE))
+    return parser.parse_args()
 
 def main():
     '''
     Parse SCPD XML file from stdin,
     Write uscpd file to stdout.
     '''
-    if len(sys.argv)>=2:
+    options, args = parse_args()
+    if len(args)>0 or (options.dir is None) != (options.out is None):
         print "Usage:"
-        print "    xml2uscpd2 < input.xml > output.uscpd"
+        print "    xml2uscpd < input.xml > output.uscpd"
+        print "    xml2uscpd --dir inputdir --out outputdir"
         sys.exit(0)
-    transform(sys.stdin, sys.stdout)
+    if options.dir is not None:
+        summary = convert_directory(options.dir, options.out, options.engine, options.jobs)
+        print_summary(summary)
+        sys.exit(1 if summary['failures'] else 0)
+    ENGINES[options.engine](sys.stdin, sys.stdout)
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,256 @@
+'''
+Benchmark the archive writers against the tarfile/zipfile code they
+replace. Run from the top of the source tree:
+
+    python -m wafmodules.archivebench [options] DIRECTORY...
+'''
+
+import os
+import sys
+import json
+import time
+import gzip
+import zlib
+import shutil
+import tarfile
+import platform
+import tempfile
+import multiprocessing
+from optparse import OptionParser
+
+from wafmodules.archives import (
+    ParallelGzipWriter, DEFAULT_GZIP_LEVEL, DEFAULT_COMPRESSION_POLICY,
+    parse_compression_method)
+
+RESULTS_FORMAT = "archive-bench"
+RESULTS_VERSION = 1
+
+def list_files(directories):
+    '''
+    (path, name inside the archive) for every file under the
+    directories, in a stable order.
+    '''
+    members = []
+    for directory in directories:
+        directory = os.path.abspath(directory)
+        prefix = os.path.basename(directory)
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                filepath = os.path.join(dirpath, filename)
+                members.append((filepath, os.path.join(prefix, os.path.relpath(filepath, directory))))
+    return members
+
+#########
+# Rules #
+#########
+
+# Each writer takes (output filename, members, level, threads) and writes
+# a tar.gz containing the members.
+
+def write_tgz_tarfile(filename, members, level, threads):
+    '''What simpletgzrule used to do.'''
+    tarf = tarfile.open(filename, 'w:gz', compresslevel=level)
+    for filepath, arcname in members:
+        tarf.add(filepath, arcname)
+    tarf.close()
+
+def write_tgz_parallel(filename, members, level, threads):
+    gzfile = ParallelGzipWriter(filename, level, threads)
+    try:
+        tarf = tarfile.open(fileobj=gzfile, mode='w')
+        for filepath, arcname in members:
+            tarf.add(filepath, arcname)
+        tarf.close()
+    finally:
+        gzfile.close()
+
+WRITERS = [
+    ('tarfile', write_tgz_tarfile),
+    ('parallel', write_tgz_parallel),
+]
+
+def read_tar_names(filename):
+    '''
+    Read the whole archive back, checking the gzip CRC and length, and
+    return the names of its members.
+    '''
+    with open(filename, 'rb') as f:
+        tarf = tarfile.open(fileobj=gzip.GzipFile(fileobj=f, mode='rb'), mode='r|')
+        names = []
+        for info in tarf:
+            if info.isfile():
+                tarf.extractfile(info).read()
+            names.append(info.name)
+        tarf.close()
+    return names
+
+def run_benchmarks(members, writer_names, levels, threads, repeat):
+    input_bytes = sum(os.path.getsize(filepath) for filepath, arcname in members)
+    expected_names = [arcname for filepath, arcname in members]
+    tempdir = tempfile.mkdtemp(prefix='archivebench')
+    results = []
+    try:
+        for level in levels:
+            for writer_name in writer_names:
+                writer = dict(WRITERS)[writer_name]
+                filename = os.path.join(tempdir, '%s-%s.tar.gz' % (writer_name, level))
+                best = None
+                for i in xrange(repeat):
+                    start = time.time()
+                    writer(filename, members, level, threads)
+                    seconds = time.time() - start
+                    if best is None or seconds < best:
+                        best = seconds
+                if read_tar_names(filename) != expected_names:
+                    raise Exception("%s at level %s wrote the wrong members." % (writer_name, level))
+                output_bytes = os.path.getsize(filename)
+                results.append({
+                    'writer' : writer_name,
+                    'level' : level,
+                    'threads' : threads if writer_name == 'parallel' else 1,
+                    'files' : len(members),
+                    'input_bytes' : input_bytes,
+                    'output_bytes' : output_bytes,
+                    'ratio' : output_bytes / float(max(input_bytes, 1)),
+                    'seconds' : best,
+                    'mb_per_second' : input_bytes / max(best, 1e-9) / (1024 * 1024),
+                })
+    finally:
+        shutil.rmtree(tempdir)
+    return results
+
+################
+# By file type #
+################
+
+TYPE_METHODS = ['store', 'deflate:1', 'deflate:6', 'deflate:9']
+
+def file_type(arcname):
+    extension = os.path.splitext(arcname)[1].lower()
+    return extension or '(none)'
+
+def compress_all(datas, level):
+    '''Deflate each file separately, as a zip does. Returns the total size.'''
+    if level == 0:
+        return sum(len(data) for data in datas)
+    total = 0
+    for data in datas:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        total += len(compressor.compress(data)) + len(compressor.flush())
+    return total
+
+def run_type_benchmarks(members, methods, repeat):
+    '''
+    Compress the files of each type with each method, to see which
+    types are worth compressing. The files are read before timing
+    starts. Also reports the method that the default compression policy
+    chooses for each type.
+    '''
+    by_type = {}
+    for filepath, arcname in members:
+        with open(filepath, 'rb') as f:
+            by_type.setdefault(file_type(arcname), []).append((arcname, f.read()))
+    results = []
+    for typ in sorted(by_type):
+        arcnames = [arcname for arcname, data in by_type[typ]]
+        datas = [data for arcname, data in by_type[typ]]
+        input_bytes = sum(len(data) for data in datas)
+        policy_level = DEFAULT_COMPRESSION_POLICY.get_level(arcnames[0], None)
+        for method in methods:
+            level = parse_compression_method(method)
+            if level is None:
+                level = zlib.Z_DEFAULT_COMPRESSION
+            best = None
+            for i in xrange(repeat):
+                start = time.time()
+                output_bytes = compress_all(datas, level)
+                seconds = time.time() - start
+                if best is None or seconds < best:
+                    best = seconds
+            results.append({
+                'type' : typ,
+                'method' : method,
+                'policy' : 'store' if policy_level == 0 else 'deflate',
+                'files' : len(datas),
+                'input_bytes' : input_bytes,
+                'output_bytes' : output_bytes,
+                'ratio' : output_bytes / float(max(input_bytes, 1)),
+                'seconds' : best,
+                'mb_per_second' : input_bytes / max(best, 1e-9) / (1024 * 1024),
+            })
+    return results
+
+def print_type_results(results, outfile=None):
+    if outfile is None:
+        outfile = sys.stdout
+    outfile.write("%-10s %-10s %-8s %6s %12s %12s %8s %9s %10s\n" % (
+        "type", "method", "policy", "files", "input bytes", "output bytes", "ratio", "seconds", "MB/s"))
+    for r in results:
+        outfile.write("%-10s %-10s %-8s %6s %12s %12s %8.4f %9.3f %10.1f\n" % (
+            r['type'], r['method'], r['policy'], r['files'], r['input_bytes'],
+            r['output_bytes'], r['ratio'], r['seconds'], r['mb_per_second']))
+
+###########
+# Results #
+###########
+
+def results_to_string(results):
+    return json.dumps({
+            'format' : RESULTS_FORMAT,
+            'version' : RESULTS_VERSION,
+            'python' : platform.python_version(),
+            'platform' : platform.platform(),
+            'cpus' : multiprocessing.cpu_count(),
+            'results' : results,
+        }, indent=1, sort_keys=True) + "\n"
+
+def print_results(results, outfile=None):
+    if outfile is None:
+        outfile = sys.stdout
+    outfile.write("%-10s %5s %7s %9s %10s %14s %8s\n" % (
+        "writer", "level", "threads", "seconds", "MB/s", "output bytes", "ratio"))
+    for r in results:
+        outfile.write("%-10s %5s %7s %9.3f %10.1f %14s %8.4f\n" % (
+            r['writer'], r['level'], r['threads'], r['seconds'],
+            r['mb_per_second'], r['output_bytes'], r['ratio']))
+
+def parse_args():
+    writer_names = [name for (name, writer) in WRITERS]
+    usage = (
+        "\n"+
+        "    %prog [options] DIRECTORY...\n"+
+        "\n"+
+        "Archive the directories as tar.gz with each writer and compare\n"+
+        "their times and output sizes.")
+    parser = OptionParser(usage=usage)
+    parser.add_option("-o", "--output", dest="output", action="store", default=None, help="Write the results as JSON to this file.")
+    parser.add_option("--writer", dest="writers", action="append", type="choice", choices=writer_names, default=None, help="Writer to run, one of %s. May be given more than once. (Default = all)" % (", ".join(writer_names),))
+    parser.add_option("--level", dest="levels", action="append", type="int", default=None, help="gzip compression level. May be given more than once. (Default = %s)" % (DEFAULT_GZIP_LEVEL,))
+    parser.add_option("--threads", dest="threads", action="store", type="int", default=multiprocessing.cpu_count(), help="Threads for the parallel writer. (Default = number of CPUs)")
+    parser.add_option("--by-type", dest="by_type", action="store_true", default=False, help="Instead of comparing writers, compare compression methods for each file type.")
+    parser.add_option("--method", dest="methods", action="append", default=None, help="With --by-type, a compression method to try: store, deflate or deflate:<0-9>. May be given more than once. (Default = %s)" % (", ".join(TYPE_METHODS),))
+    parser.add_option("--repeat", dest="repeat", action="store", type="int", default=3, help="Time each writer this many times and report the fastest. (Default = 3)")
+    return parser.parse_args()
+
+def main():
+    options, args = parse_args()
+    if len(args) == 0 or options.threads < 1 or options.repeat < 1:
+        print "Usage:"
+        print "    python -m wafmodules.archivebench [-o results.json] DIRECTORY..."
+        sys.exit(0)
+    members = list_files(args)
+    if options.by_type:
+        results = run_type_benchmarks(members, options.methods or TYPE_METHODS, options.repeat)
+        print_type_results(results)
+    else:
+        writer_names = options.writers or [name for (name, writer) in WRITERS]
+        levels = options.levels or [DEFAULT_GZIP_LEVEL]
+        results = run_benchmarks(members, writer_names, levels, options.threads, options.repeat)
+        print_results(results)
+    if options.output is not None:
+        with open(options.output, "w") as outfile:
+            outfile.write(results_to_string(results))
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,255 @@
+'''
+Check the archive writers: that the parallel writers give the same
+archives as a single thread, that an incremental zip is the same as a
+fresh one, and that deterministic archives are byte-identical from run
+to run. Run from the top of the source tree:
+
+    python -m wafmodules.archivecheck
+
+filetasks needs waflib, which ./waf unpacks into the top of the source
+tree the first time it runs.
+'''
+
+import os
+import sys
+import glob
+import gzip
+import time
+import random
+import shutil
+import tarfile
+import zipfile
+import tempfile
+from optparse import OptionParser
+
+TOP = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+try:
+    import waflib
+except ImportError:
+    for directory in sorted(glob.glob(os.path.join(TOP, '.waf-*')) + glob.glob(os.path.join(TOP, 'waf-*'))):
+        if os.path.isdir(os.path.join(directory, 'waflib')):
+            sys.path.insert(0, directory)
+            break
+
+from wafmodules.archives import ParallelGzipWriter, DEFAULT_COMPRESSION_POLICY
+from wafmodules.filetasks import write_zip, write_tgz, FileTree
+
+class CheckFailed(Exception):
+    pass
+
+def check_equal(what, expected, actual):
+    if expected != actual:
+        raise CheckFailed("%s differ." % (what,))
+
+def read_file(filename):
+    with open(filename, 'rb') as f:
+        return f.read()
+
+############
+# Fixtures #
+############
+
+def make_files(directory, seed):
+    '''
+    Write a small tree of text and incompressible files, with one file
+    hard-linked from a second place, and return its members as
+    (filename, arcname) in no particular order.
+    '''
+    rand = random.Random(seed)
+    members = []
+    def add(arcname, content):
+        filename = os.path.join(directory, arcname)
+        if not os.path.isdir(os.path.dirname(filename)):
+            os.makedirs(os.path.dirname(filename))
+        with open(filename, 'wb') as f:
+            f.write(content)
+        members.append((filename, arcname))
+    for n in xrange(40):
+        add('text/file%s.txt' % (n,), ''.join('line %s of file %s\n' % (i, n) for i in xrange(rand.randint(0, 3000))))
+    for n in xrange(10):
+        add('images/image%s.png' % (n,), ''.join(chr(rand.randint(0, 255)) for i in xrange(rand.randint(1, 50000))))
+    add('empty.txt', '')
+    linked = os.path.join(directory, 'linked.txt')
+    if hasattr(os, 'link'):
+        os.link(os.path.join(directory, 'text', 'file1.txt'), linked)
+        members.append((linked, 'linked.txt'))
+    members.reverse()
+    return members
+
+def touch_all(members):
+    '''Give every file a new modification time, as a rebuild would.'''
+    later = time.time() + 100
+    for filename, arcname in members:
+        os.utime(filename, (later, later))
+
+##########
+# Checks #
+##########
+
+# Each check is given a fresh temporary directory and raises CheckFailed
+# if something is wrong.
+
+def check_parallel_gzip(tempdir):
+    '''
+    The block-parallel gzip writer gives a standard gzip file of exactly
+    what was written, including when the level changes part way through.
+    '''
+    rand = random.Random(1)
+    data = []
+    filename = os.path.join(tempdir, 'data.gz')
+    with ParallelGzipWriter(filename, level=6, threads=3, block_size=64 * 1024) as gzfile:
+        for n in xrange(200):
+            if n % 50 == 0:
+                gzfile.set_level(rand.choice([0, 1, 6, 9]))
+            chunk = ''.join(chr(rand.randint(0, 255) if n % 3 else 65 + i % 26) for i in xrange(rand.randint(0, 20000)))
+            gzfile.write(chunk)
+            data.append(chunk)
+        check_equal("tell() and the amount written", len(''.join(data)), gzfile.tell())
+    check_equal("The gzip file's contents and what was written", ''.join(data), gzip.GzipFile(filename, 'rb').read())
+
+def check_parallel_zip(tempdir):
+    '''
+    A zip deflated by several threads is the same as one deflated by
+    one thread, and holds the files it was given.
+    '''
+    members = make_files(os.path.join(tempdir, 'files'), 2)
+    one = os.path.join(tempdir, 'one.zip')
+    many = os.path.join(tempdir, 'many.zip')
+    write_zip(one, members, threads=1, deterministic=True, policy=DEFAULT_COMPRESSION_POLICY)
+    write_zip(many, members, threads=4, deterministic=True, policy=DEFAULT_COMPRESSION_POLICY)
+    check_equal("Zips written by one thread and by four", read_file(one), read_file(many))
+    zf = zipfile.ZipFile(many)
+    check_equal("Zip members that fail their CRC", None, zf.testzip())
+    for filename, arcname in members:
+        check_equal("The zipped and original %s" % (arcname,), read_file(filename), zf.read(arcname))
+
+def check_incremental_zip(tempdir):
+    '''
+    Rebuilding a zip incrementally, reusing its unchanged members, gives
+    the same zip as writing it from scratch.
+    '''
+    members = make_files(os.path.join(tempdir, 'files'), 3)
+    incremental = os.path.join(tempdir, 'incremental.zip')
+    fresh = os.path.join(tempdir, 'fresh.zip')
+    write_zip(incremental, members[5:], deterministic=True, incremental=True, policy=DEFAULT_COMPRESSION_POLICY)
+    with open(members[-1][0], 'ab') as f:
+        f.write('changed\n')
+    for deterministic in [True, False]:
+        # Without deterministic, the members keep their own timestamps,
+        # which are the same for both zips.
+        write_zip(incremental, members, deterministic=deterministic, incremental=True, policy=DEFAULT_COMPRESSION_POLICY)
+        write_zip(fresh, members, deterministic=deterministic, policy=DEFAULT_COMPRESSION_POLICY)
+        check_equal("Incremental and fresh zips (deterministic=%s)" % (deterministic,), read_file(fresh), read_file(incremental))
+
+def check_deterministic_tgz(tempdir):
+    '''
+    A deterministic tar.gz is byte-identical from run to run, even when
+    the files' timestamps and the order of the members change, and
+    every file is written in full, even if it is hard-linked to
+    another.
+    '''
+    directory = os.path.join(tempdir, 'files')
+    members = make_files(directory, 4)
+    # The gzip header holds the file's name, so both runs write the same
+    # name, as a rebuild would.
+    first = os.path.join(tempdir, 'first', 'files.tar.gz')
+    second = os.path.join(tempdir, 'second', 'files.tar.gz')
+    os.makedirs(os.path.dirname(first))
+    os.makedirs(os.path.dirname(second))
+    write_tgz(first, members, 6, True, DEFAULT_COMPRESSION_POLICY)
+    touch_all(members)
+    time.sleep(1)
+    write_tgz(second, list(reversed(members)), 6, True, DEFAULT_COMPRESSION_POLICY)
+    check_equal("Deterministic tar.gz files from two runs", read_file(first), read_file(second))
+    tarf = tarfile.open(second)
+    for tarinfo in tarf:
+        if not tarinfo.isfile():
+            raise CheckFailed("%s isn't written as a regular file." % (tarinfo.name,))
+    for filename, arcname in members:
+        check_equal("The archived and original %s" % (arcname,), read_file(filename), tarf.extractfile(arcname).read())
+
+def check_tgz_directories(tempdir):
+    '''
+    A directory is added with its contents whether or not the tar.gz is
+    deterministic.
+    '''
+    directory = os.path.join(tempdir, 'files')
+    make_files(directory, 5)
+    names = {}
+    for deterministic in [False, True]:
+        filename = os.path.join(tempdir, '%s.tar.gz' % (deterministic,))
+        write_tgz(filename, [(directory, 'files')], 6, deterministic, DEFAULT_COMPRESSION_POLICY)
+        names[deterministic] = tarfile.open(filename).getnames()
+    check_equal("The members of normal and deterministic tar.gz files", names[False], names[True])
+
+def check_file_tree(tempdir):
+    '''
+    Lazily combined and transformed FileTrees give the same paths as
+    doing each step straight away.
+    '''
+    a = ['a/one.txt', 'a/sub/two.txt']
+    b = ['b/three.txt']
+    tree = FileTree(a).strip_prefix('a').add_prefix('x') + FileTree(b).flatten().add_prefix('y')
+    for n in xrange(2000):
+        tree = tree + FileTree(['c/%s.txt' % (n,)])
+    tree = tree.add_prefix('top')
+    expected = (
+        [os.path.join('top', 'x', 'one.txt'), os.path.join('top', 'x', 'sub', 'two.txt'), os.path.join('top', 'y', 'three.txt')] +
+        [os.path.join('top', 'c', '%s.txt' % (n,)) for n in xrange(2000)])
+    check_equal("Lazy and eager FileTree paths", expected, tree.files)
+
+CHECKS = [
+    ('parallel gzip', check_parallel_gzip),
+    ('parallel zip', check_parallel_zip),
+    ('incremental zip', check_incremental_zip),
+    ('deterministic tgz', check_deterministic_tgz),
+    ('tgz directories', check_tgz_directories),
+    ('file tree', check_file_tree),
+]
+
+def run_checks(names):
+    '''
+    Run the named checks, printing a line for each. Returns the number
+    that failed.
+    '''
+    failed = 0
+    for name, check in CHECKS:
+        if name not in names:
+            continue
+        tempdir = tempfile.mkdtemp(prefix='archivecheck')
+        try:
+            check(tempdir)
+        except CheckFailed, e:
+            print "FAIL %s: %s" % (name, e)
+            failed += 1
+        else:
+            print "ok   %s" % (name,)
+        finally:
+            shutil.rmtree(tempdir)
+    return failed
+
+def parse_args():
+    check_names = [name for (name, check) in CHECKS]
+    usage = (
+        "\n"+
+        "    %prog [options]\n"+
+        "\n"+
+        "Check the archive writers against their simpler equivalents.")
+    parser = OptionParser(usage=usage)
+    parser.add_option("--check", dest="checks", action="append", type="choice", choices=check_names, default=None, help="Check to run, one of %s. May be given more than once. (Default = all)" % (", ".join(check_names),))
+    return parser.parse_args()
+
+def main():
+    options, args = parse_args()
+    if len(args) > 0:
+        print "Usage:"
+        print "    python -m wafmodules.archivecheck [--check NAME]..."
+        sys.exit(0)
+    failed = run_checks(options.checks or [name for (name, check) in CHECKS])
+    if failed:
+        print "%s checks failed." % (failed,)
+        sys.exit(1)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,189 @@
+'''
+Archive writers that don't depend on waf, so that they can also be used
+and benchmarked outside a build.
+'''
+
+import os
+import re
+import time
+import fnmatch
+import zlib
+import struct
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_GZIP_LEVEL = 9          # The same as tarfile's 'w:gz' and gzip.GzipFile.
+DEFAULT_GZIP_BLOCK_SIZE = 1024 * 1024
+
+def parse_compression_method(method):
+    '''
+    Turn a compression method as written in a policy into a level: 0 for
+    'store', None for 'deflate' at the archive's usual level, or N for
+    'deflate:N'.
+    '''
+    if method == 'store':
+        return 0
+    if method == 'deflate':
+        return None
+    if method.startswith('deflate:'):
+        try:
+            level = int(method[len('deflate:'):])
+        except ValueError:
+            level = -1
+        if 0 <= level <= 9:
+            return level
+    if method == 'lzma':
+        # Neither zipfile nor tarfile can write lzma in Python 2, and what
+        # reads the app zips doesn't support lzma members.
+        raise Exception("Compression method 'lzma' isn't supported for these archives.")
+    raise Exception("Unknown compression method '{0}'. Expected 'store', 'deflate' or 'deflate:<0-9>'.".format(method))
+
+class CompressionPolicy(object):
+    '''
+    Chooses how to compress each member of an archive from its name inside
+    the archive. rules is a sequence of (glob pattern, method), where the
+    first pattern that matches wins and the method is 'store', 'deflate'
+    or 'deflate:<level>'. Patterns are case-insensitive, and '*' matches
+    across directories, so '*.png' matches every PNG.
+    '''
+    def __init__(self, rules, default='deflate'):
+        self.rules = list(rules)
+        self.default = default
+        self._rules = [
+            (re.compile(fnmatch.translate(pattern), re.IGNORECASE), parse_compression_method(method))
+            for (pattern, method) in self.rules]
+        self._default = parse_compression_method(default)
+    def get_level(self, name, default_level):
+        '''
+        The compression level for a member: 0 to store it, otherwise a
+        deflate level, default_level if the policy doesn't say.
+        '''
+        level = self._default
+        for regex, rule_level in self._rules:
+            if regex.match(name):
+                level = rule_level
+                break
+        return default_level if level is None else level
+    def __repr__(self):
+        # Also used as the policy's part of a task's signature.
+        return 'CompressionPolicy(%r, %r)' % (self.rules, self.default)
+
+# Already compressed formats gain nothing from deflating again.
+DEFAULT_COMPRESSION_POLICY = CompressionPolicy(
+    [(pattern, 'store') for pattern in [
+        '*.png', '*.jpg', '*.jpeg', '*.gif', '*.webp',
+        '*.mp3', '*.ogg', '*.flac', '*.aac', '*.m4a', '*.mp4', '*.avi', '*.mkv',
+        '*.woff', '*.woff2',
+        '*.zip', '*.gz', '*.tgz', '*.bz2', '*.xz', '*.7z', '*.jar', '*.nupkg',
+        ]])
+
+def _deflate_block(data, level, final):
+    '''
+    Compress one block as raw deflate data. A block that isn't final ends
+    with a sync flush, which leaves the output on a byte boundary without
+    ending the stream, so the compressed blocks can simply be
+    concatenated.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    output = compressor.compress(data)
+    return output + compressor.flush(zlib.Z_FINISH if final else zlib.Z_SYNC_FLUSH)
+
+class ParallelGzipWriter(object):
+    '''
+    A write-only file object that produces a standard, single-member gzip
+    file, compressing blocks of its input concurrently in a pool of
+    threads. zlib releases the GIL while compressing.
+
+    Each block is compressed independently, so matches can't refer back
+    into the previous block; with 1MB blocks that costs a fraction of a
+    percent in size. The CRC is calculated in the calling thread, in
+    order.
+    '''
+    def __init__(self, filename, level=DEFAULT_GZIP_LEVEL, threads=None, block_size=DEFAULT_GZIP_BLOCK_SIZE, mtime=None):
+        self.name = filename
+        self.level = level
+        self.block_size = block_size
+        self.threads = threads or multiprocessing.cpu_count()
+        self._file = open(filename, 'wb')
+        self._pool = ThreadPool(self.threads)
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._crc = 0
+        self._size = 0
+        self.closed = False
+        self._write_header(filename, mtime)
+    def _write_header(self, filename, mtime):
+        # Same header fields as gzip.GzipFile: the original file name, the
+        # modification time and the "extra flags" for the level.
+        basename = os.path.basename(filename)
+        if basename.endswith('.gz'):
+            basename = basename[:-3]
+        if mtime is None:
+            mtime = time.time()
+        extra_flags = 2 if self.level == 9 else 4 if self.level == 1 else 0
+        self._file.write('\037\213\010')
+        self._file.write(chr(0x08 if basename else 0))
+        self._file.write(struct.pack('<L', long(mtime) & 0xffffffffL))
+        self._file.write(chr(extra_flags) + '\377')
+        if basename:
+            self._file.write(basename + '\000')
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write() on closed ParallelGzipWriter")
+        self._buffer.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.block_size:
+            block = ''.join(self._buffer)
+            for start in xrange(0, len(block) - self.block_size + 1, self.block_size):
+                self._submit(block[start:start + self.block_size], False)
+            remainder = block[start + self.block_size:]
+            self._buffer = [remainder]
+            self._buffered = len(remainder)
+    def set_level(self, level):
+        '''
+        Compress what is written from now on at a different level. The
+        data so far is sent to be compressed at the old level, so calling
+        this often makes for small blocks and a worse ratio.
+        '''
+        if level == self.level:
+            return
+        if self._buffered:
+            self._submit(''.join(self._buffer), False)
+            self._buffer = []
+            self._buffered = 0
+        self.level = level
+    def tell(self):
+        '''The number of uncompressed bytes written so far, as GzipFile does.'''
+        return self._size + self._buffered
+    def _submit(self, block, final):
+        self._crc = zlib.crc32(block, self._crc)
+        self._size += len(block)
+        self._pending.append(self._pool.apply_async(_deflate_block, (block, self.level, final)))
+        # Keep a few blocks in hand for each thread, but no more, so that
+        # memory use doesn't grow with the size of the input.
+        while len(self._pending) > 2 * self.threads:
+            self._file.write(self._pending.popleft().get())
+    def flush(self):
+        pass
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._submit(''.join(self._buffer), True)
+            self._buffer = []
+            self._buffered = 0
+            while self._pending:
+                self._file.write(self._pending.popleft().get())
+            self._file.write(struct.pack('<LL', self._crc & 0xffffffffL, self._size & 0xffffffffL))
+        finally:
+            self._pool.close()
+            self._pool.join()
+            self._file.close()
+    def __enter__(self):
+        return self
+    def __exit__(self, exc_type, exc_value, tb):
+        self.close()
+        return False
@@ -2,9 +2,15 @@ import platform
 import subprocess
 import fnmatch
 import os
+import re
 from os import path
 import string
 import glob
+import cPickle
+import tempfile
+import hashlib
+
+from wafmodules.tracing import traced
 
 # Pythons < 2.7 don't have check_output:
 def check_output(*args, **kwargs):
@@ -25,14 +31,90 @@ class AmbiguousMatchException(Exception):
     def __init__(self, key, candidates, *args, **kwargs):
         Exception.__init__(self, "key=%s, candidates=%s" % (repr(key), repr(candidates)), *args, **kwargs)
 
+class WildcardTable(object):
+    """
+    A dictionary whose keys are strings with Unix-style wildcards (i.e. *, ?
+    and []), prepared for repeated lookups. The patterns are compiled once,
+    which patterns are at least as specific as which others is worked out
+    once, and the result of looking up each key is remembered. The table
+    is a copy: changing the dictionary afterwards doesn't change it.
+    """
+    def __init__(self, dictionary):
+        self._patterns = list(dictionary.keys())
+        self._values = [dictionary[k] for k in self._patterns]
+        self._regexes = [re.compile(fnmatch.translate(k)) for k in self._patterns]
+        # _covers[i] is the set of indices j such that pattern j matches
+        # pattern i, i.e. pattern i is at least as specific as pattern j.
+        # E.g. "Linux-*" covers "*", but neither "Linux-*" nor "*-x86"
+        # covers the other.
+        self._covers = [
+                frozenset(j for (j, regex) in enumerate(self._regexes) if regex.match(pattern))
+                for pattern in self._patterns]
+        self._matches = {}
+        self._lookups = {}
+    def matching_patterns(self, key):
+        """
+        Return the patterns that match key, in the order of the original
+        dictionary's keys.
+        """
+        indices = self._matching_indices(key)
+        return [self._patterns[i] for i in indices]
+    def _matching_indices(self, key):
+        indices = self._matches.get(key)
+        if indices is None:
+            indices = self._matches[key] = [
+                    i for (i, regex) in enumerate(self._regexes) if regex.match(key)]
+        return indices
+    def lookup(self, key):
+        """
+        Find the value of the most specific pattern matching key.
+        Raises KeyError if there is no match.
+        Raises AmbiguousMatchException if there are multiple matches and none
+        of them is most specific.
+        """
+        if key not in self._lookups:
+            self._lookups[key] = self._find(key)
+        index = self._lookups[key]
+        if index is None:
+            indices = self._matching_indices(key)
+            if len(indices) == 0:
+                raise KeyError(key)
+            raise AmbiguousMatchException(key=key, candidates=[self._patterns[i] for i in indices])
+        return self._values[index]
+    def _find(self, key):
+        indices = self._matching_indices(key)
+        for i in indices:
+            # Determine if pattern i is strictly a better match than every
+            # other matched pattern.
+            covers = self._covers[i]
+            if all(j in covers for j in indices if j != i):
+                return i
+        return None
+
+def freeze_platform_table(path):
+    """
+    Turn a path that may be a dictionary of paths keyed by platform
+    wildcards, nested to any depth, into WildcardTables, so that
+    resolving it for each platform doesn't redo the pattern matching.
+    """
+    if isinstance(path, dict):
+        return WildcardTable(dict(
+            (k, freeze_platform_table(v)) for (k, v) in path.items()))
+    return path
+
 def wildcard_dict_lookup(key, dictionary):
     """
     Given a dictionary where the keys are strings with Unix-style wildcards
     (i.e. *, ? and []) find the most specific match for the key in the dictionary.
+    The dictionary can also be a WildcardTable, which is quicker when looking
+    up several keys. A plain dictionary is scanned, since building a table
+    costs more than one lookup.
     Raises KeyError if there is no match.
     Raises AmbiguousMatchException if there are multiple matches and none of them
     is most specific.
     """
+    if isinstance(dictionary, WildcardTable):
+        return dictionary.lookup(key)
     matching_keys = [k for k in dictionary.keys() if fnmatch.fnmatchcase(key, k)]
     # All of matching_keys are either equal to key
     # or match it by means of wildcards.
@@ -52,8 +134,8 @@ def wildcard_dict_lookup(key, dictionary):
     raise AmbiguousMatchException(key=key, candidates=matching_keys)
 
 def resolve_path_for_platform(path, platform):
-    if isinstance(path, dict):
-        return resolve_path_for_platform(wildcard_dict_lookup(platform, path), platform)
+    while isinstance(path, (dict, WildcardTable)):
+        path = wildcard_dict_lookup(platform, path)
     return path
 
 def get_platform(conf):
@@ -86,9 +168,149 @@ def platform_match(target_platform, allowed_platforms):
     allowed_platforms should be a string or a list of strings, and can contain
     wildcards, e.g.: ["Linux-*", "*-ARM"] or "Windows-x86".
     """
-    if isinstance(allowed_platforms, list):
-        return any(platform_match(target_platform, p) for p in allowed_platforms)
-    return fnmatch.fnmatchcase(target_platform, allowed_platforms)
+    if not isinstance(allowed_platforms, list):
+        allowed_platforms = [allowed_platforms]
+    table = _platform_tables.get(tuple(allowed_platforms))
+    if table is None:
+        table = _platform_tables[tuple(allowed_platforms)] = WildcardTable(
+                dict((p, True) for p in allowed_platforms))
+    return len(table.matching_patterns(target_platform)) > 0
+
+# WildcardTables for the lists of platforms passed to platform_match.
+_platform_tables = {}
+
+def write_pickle(filename, value):
+    """
+    Pickle value to filename atomically, so that a reader never sees a
+    partly written file.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=path.dirname(filename), prefix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            cPickle.dump(value, f, cPickle.HIGHEST_PROTOCOL)
+        if os.name == 'nt' and path.exists(filename):
+            os.remove(filename)
+        os.rename(tmpname, filename)
+    except:
+        if path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+
+def read_pickle(filename, default=None):
+    """
+    Unpickle the contents of filename, or return default if it is missing
+    or unreadable.
+    """
+    try:
+        with open(filename, 'rb') as f:
+            return cPickle.load(f)
+    except (IOError, EOFError, ValueError, TypeError, AttributeError, ImportError, IndexError, cPickle.UnpicklingError):
+        return default
+
+def get_mtime(filename):
+    try:
+        return os.stat(filename).st_mtime
+    except OSError:
+        return None
+
+# Name of the file, in the build directory, that holds the DependencyIndex
+# between runs of waf configure.
+DEPENDENCY_INDEX_FILE = '.dependencies-index'
+
+class DependencyIndex(object):
+    """
+    Cached listings of the subdirectories of every directory under root
+    that has been searched, used to answer in_dependencies globs without
+    re-reading the same directories for every CSharpDirectory. Each
+    listing is stored with the mtime of its directory, and is reread only
+    if that has changed, so an index loaded from a previous run is
+    revalidated with one stat per directory.
+    """
+    def __init__(self, root):
+        self.root = root
+        self._listings = {}
+        self._checked = set()
+        self._changed = False
+    def load(self, filename):
+        root, listings = read_pickle(filename, (None, None))
+        if root == self.root:
+            self._listings = listings
+    def save(self, filename):
+        if not self._changed:
+            return
+        write_pickle(filename, (self.root, self._listings))
+        self._changed = False
+    def get_directory_mtimes(self):
+        """
+        Return {absolute path: mtime} for every directory that has been
+        listed, with None for those that didn't exist.
+        """
+        return dict(
+                (path.join(self.root, relative_dir), mtime)
+                for (relative_dir, (mtime, names)) in self._listings.items())
+    def subdirectories(self, relative_dir):
+        """
+        Return the sorted names of the subdirectories of relative_dir, a
+        path relative to root. Returns [] if it isn't a directory.
+        """
+        cached = self._listings.get(relative_dir)
+        if relative_dir in self._checked:
+            return cached[1]
+        full_path = path.join(self.root, relative_dir)
+        mtime = get_mtime(full_path)
+        if mtime is None:
+            cached = (None, [])
+        elif cached is None or cached[0] != mtime:
+            try:
+                names = sorted(
+                        name for name in os.listdir(full_path)
+                        if path.isdir(path.join(full_path, name)))
+            except OSError:
+                names = []
+            cached = (mtime, names)
+        if self._listings.get(relative_dir) != cached:
+            self._listings[relative_dir] = cached
+            self._changed = True
+        self._checked.add(relative_dir)
+        return cached[1]
+    @traced
+    def glob(self, pattern):
+        """
+        Return the absolute paths of the directories under root matching
+        pattern, a relative path that may contain wildcards in any of its
+        components, in the same way as glob.glob.
+        """
+        components = [c for c in pattern.replace(os.sep, '/').split('/') if c not in ('', '.')]
+        if '..' in components:
+            return sorted(p for p in glob.glob(path.join(self.root, pattern)) if path.isdir(p))
+        matches = ['']
+        for component in components:
+            next_matches = []
+            for relative_dir in matches:
+                names = self.subdirectories(relative_dir)
+                if glob.has_magic(component):
+                    names = fnmatch.filter(names, component)
+                    if not component.startswith('.'):
+                        names = [name for name in names if not name.startswith('.')]
+                    next_matches.extend(path.join(relative_dir, name) for name in names)
+                elif path.normcase(component) in [path.normcase(name) for name in names]:
+                    next_matches.append(path.join(relative_dir, component))
+            matches = next_matches
+        return [path.join(self.root, relative_path) for relative_path in matches]
+
+# Name of the file, in the top directory, that remembers the outcome of
+# the last full dependency configuration. It lives outside the build
+# directory so that it survives "waf distclean", which CI runs before
+# every configure.
+CONFIGURE_CACHE_FILE = '.dependencies-configure-cache'
+CONFIGURE_CACHE_VERSION = 2
+
+def file_digest(filename):
+    try:
+        with open(filename, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except IOError:
+        return None
 
 import shutil
 
@@ -105,6 +327,7 @@ class CSharpDependencyCollection(object):
     def __init__(self):
         self._packagelist = []
         self.packages = {}
+        self._resolved = None
     def add_package(self, name):
         if name in self.packages:
             raise ValueError("Duplicate package with name '%s'" % (name,))
@@ -115,42 +338,111 @@ class CSharpDependencyCollection(object):
     def options(self, opt):
         for pkg in self._packagelist:
             pkg.options(opt)
+    @traced
     def configure(self, conf, defaults = {}):
+        index_filename = path.join(conf.bldnode.abspath(), DEPENDENCY_INDEX_FILE)
+        conf.dependency_index = DependencyIndex(path.abspath('dependencies'))
+        conf.dependency_index.load(index_filename)
+        conf.pkg_config_results = probe_pkg_configs(
+                [pkg.pkg for pkg in self._packagelist if pkg.wants_pkg_config(conf)],
+                path.join(conf.bldnode.abspath(), PKG_CONFIG_CACHE_FILE))
         for pkg in self._packagelist:
             pkg.configure(conf, defaults)
+        conf.dependency_index.save(index_filename)
+    @traced
     def validate(self, conf):
         for pkg in self._packagelist:
             pkg.validate(conf)
     def load_from_env(self, env):
         for pkg in self._packagelist:
             pkg.load_from_env(env)
-    def get_csflags_for_packages(self, bld, package_names):
-        csflags = []
-        remaining_package_names = set(package_names)
+    def _get_configure_fingerprint(self, conf, defaults, input_files):
+        """
+        Hash everything that configure and validate depend on, other than
+        the contents of the directories they look in: the options, the
+        platform, the packages being configured and how they are
+        defined, the .pc files pkg-config would read, and input_files.
+        """
+        source_file = path.splitext(__file__)[0] + '.py'
+        pc_files = []
+        if any(pkg.pkg is not None for pkg in self._packagelist):
+            pc_files = get_pc_file_mtimes(get_pkg_config_search_path(
+                path.join(conf.bldnode.abspath(), PKG_CONFIG_CACHE_FILE)))
+        inputs = (
+            CONFIGURE_CACHE_VERSION,
+            sorted(vars(conf.options).items()),
+            conf.env.PLATFORM,
+            conf.env.cshlib_PATTERN,
+            sorted(defaults.items()),
+            os.environ.get('PKG_CONFIG_PATH'),
+            os.environ.get('PKG_CONFIG_LIBDIR'),
+            pc_files,
+            [pkg.name for pkg in self._packagelist],
+            [(f, file_digest(f)) for f in [path.join(conf.path.abspath(), 'wscript'), source_file] + list(input_files)],
+            path.abspath('dependencies'))
+        return hashlib.sha1(repr(inputs)).hexdigest()
+    @traced
+    def configure_and_validate(self, conf, defaults = {}, input_files = []):
+        """
+        Equivalent to configure followed by validate, but if nothing they
+        depend on has changed since the last time they succeeded, restore
+        their result instead of repeating them. The directories that were
+        searched or resolved are checked by mtime; anything else that
+        matters, including input_files, is fingerprinted by
+        _get_configure_fingerprint.
+        """
+        cache_filename = path.join(conf.path.abspath(), CONFIGURE_CACHE_FILE)
+        fingerprint = self._get_configure_fingerprint(conf, defaults, input_files)
+        cached = read_pickle(cache_filename)
+        if (cached is not None and
+                cached[0] == fingerprint and
+                all(get_mtime(d) == mtime for (d, mtime) in cached[1].items())):
+            if conf.env.CSHARPDEPENDENCIES == []:
+                conf.env.CSHARPDEPENDENCIES = {}
+            conf.env.CSHARPDEPENDENCIES.update(cached[2])
+            self.load_from_env(conf.env)
+            conf.msg('Dependencies', 'unchanged since last configure')
+            return
+        self.configure(conf, defaults)
+        self.validate(conf)
+        dependencies = dict(
+                (name, conf.env.CSHARPDEPENDENCIES[name])
+                for name in self._get_env_names()
+                if name in conf.env.CSHARPDEPENDENCIES)
+        directory_mtimes = conf.dependency_index.get_directory_mtimes()
+        for value in dependencies.values():
+            if isinstance(value, str) and value != INACTIVE_PATH:
+                directory_mtimes[value] = get_mtime(value)
+        write_pickle(cache_filename, (fingerprint, directory_mtimes, dependencies))
+    def _get_env_names(self):
+        names = []
         for pkg in self._packagelist:
-            if pkg.name in remaining_package_names:
-                csflags.extend(pkg.get_csflags(bld))
-                remaining_package_names.remove(pkg.name)
-        if remaining_package_names:
-            bld.fail("Cannot resolve package names: %s" % (list(remaining_package_names),))
-        return csflags
+            names.extend(pkg.get_env_names())
+        return names
+    @traced
+    def resolve(self, bld):
+        '''
+        Return the ResolvedDependencies for this build. It is created on
+        first use, which must be after the packages have been loaded with
+        load_from_env, and is then shared by all queries during the build.
+        '''
+        if self._resolved is None or self._resolved.bld is not bld:
+            self._resolved = ResolvedDependencies(bld, self._packagelist)
+        return self._resolved
+    def get_csflags_for_packages(self, bld, package_names):
+        return self.resolve(bld).get_csflags(package_names)
     def get_assembly_names_for_packages(self, bld, package_names):
-        assembly_names = []
-        remaining_package_names = set(package_names)
-        for pkg in self._packagelist:
-            if pkg.name in remaining_package_names:
-                assembly_names.extend(pkg.get_referenced_assembly_names(bld))
-                remaining_package_names.remove(pkg.name)
-        if remaining_package_names:
-            raise Exception("Cannot resolve package names: %s" % (list(remaining_package_names),))
-        return assembly_names
+        return self.resolve(bld).get_assembly_names(package_names)
+    def get_referenced_assembly_paths_for_packages(self, bld, package_names):
+        return self.resolve(bld).get_referenced_assembly_paths(package_names)
+    def get_paths_of_files_to_copy_for_packages(self, bld, package_names):
+        return self.resolve(bld).get_paths_of_files_to_copy(package_names)
     def read_csshlibs(self, bld):
-        for pkg in self._packagelist:
-            for assembly_path in pkg.get_referenced_assembly_paths(bld):
-                assembly_dir, assembly_filename = os.path.split(assembly_path)
-                bld.read_csshlib(
-                        assembly_filename,
-                        [assembly_dir])
+        for assembly_path in self.get_referenced_assembly_paths_for_packages(bld, self.packages.keys()):
+            assembly_dir, assembly_filename = os.path.split(assembly_path)
+            bld.read_csshlib(
+                    assembly_filename,
+                    [assembly_dir])
     def create_copy_assembly_tasks(self, bld):
         for pkg in self._packagelist:
             pkg.create_copy_assembly_tasks(bld)
@@ -173,6 +465,51 @@ class CSharpDependencyCollection(object):
 
 
 
+class ResolvedDependencies(object):
+    '''
+    What each package of a CSharpDependencyCollection contributes to a
+    build, worked out once per package, with the answer for each set of
+    packages remembered. Queries return lists in the order of the
+    collection's packages, the same as asking each package in turn.
+    '''
+    def __init__(self, bld, packagelist):
+        self.bld = bld
+        self._packagelist = list(packagelist)
+        self._package_names = set(pkg.name for pkg in self._packagelist)
+        self._per_package = {}
+        self._results = {}
+    def _get(self, query, package_names, on_missing):
+        package_names = frozenset(package_names)
+        key = (query, package_names)
+        result = self._results.get(key)
+        if result is None:
+            missing = package_names - self._package_names
+            if missing:
+                on_missing("Cannot resolve package names: %s" % (list(missing),))
+            items = []
+            for pkg in self._packagelist:
+                if pkg.name in package_names:
+                    items.extend(self._get_for_package(query, pkg))
+            result = self._results[key] = tuple(items)
+        return list(result)
+    def _get_for_package(self, query, pkg):
+        key = (query, pkg.name)
+        result = self._per_package.get(key)
+        if result is None:
+            result = self._per_package[key] = tuple(getattr(pkg, query)(self.bld))
+        return result
+    def _raise(self, message):
+        raise Exception(message)
+    def get_csflags(self, package_names):
+        return self._get('get_csflags', package_names, self.bld.fail)
+    def get_assembly_names(self, package_names):
+        return self._get('get_referenced_assembly_names', package_names, self._raise)
+    def get_referenced_assembly_paths(self, package_names):
+        return self._get('get_referenced_assembly_paths', package_names, self._raise)
+    def get_paths_of_files_to_copy(self, package_names):
+        return self._get('get_paths_of_files_to_copy_to_output', package_names, self._raise)
+
+
 class CSharpDirectoryContainer(object):
     '''
     Abstract base class for "things that contain CSharpDirectories".
@@ -239,7 +576,7 @@ class CSharpDirectory(CSharpDirectoryContainer):
         """
         CSharpDirectoryContainer.__init__(self, package=package, parent=parent)
         self.unique_id = unique_id
-        self.relative_path = relative_path
+        self.relative_path = freeze_platform_table(relative_path)
         self.as_option = as_option
         self.option_help = option_help
         self.in_dependencies = in_dependencies
@@ -260,18 +597,18 @@ class CSharpDirectory(CSharpDirectoryContainer):
     def _is_active_on_platform(self, plat):
         return ((self.only_on_platform is None) or
                 platform_match(plat, self.only_on_platform))
-    def _get_candidate_locations(self, plat):
+    @traced
+    def _get_candidate_locations(self, plat, dependency_index=None):
         #print "Searching. package=%s, platform=%s" %(self.package.name, plat)
         locations = []
         if self.in_dependencies is not None:
+            if dependency_index is None:
+                dependency_index = DependencyIndex(path.abspath('dependencies'))
             in_dependencies = [self.in_dependencies] if isinstance(self.in_dependencies, (str, unicode)) else self.in_dependencies
             for dependency_location in in_dependencies:
                 expanded_pattern = string.Template(dependency_location).substitute(PLATFORM=plat)
                 #print "Pattern:", expanded_pattern
-                locations.extend(
-                        p for p in glob.glob(
-                            path.abspath(path.join('dependencies', expanded_pattern)))
-                        if path.isdir(p))
+                locations.extend(dependency_index.glob(expanded_pattern))
         if self.in_programfiles is not None:
             # Find all the "Program Files"/"Program Files (x86)" folders:
             programfiles_folders = set(
@@ -307,7 +644,7 @@ class CSharpDirectory(CSharpDirectoryContainer):
         if self.relative_path is not None:
             #print "From relative_path %s %s" % (repr(self.parent.absolute_path), repr(self.relative_path))
             return path.join(self.parent.absolute_path, resolve_path_for_platform(self.relative_path, plat))
-        candidate_locations = self._get_candidate_locations(plat)
+        candidate_locations = self._get_candidate_locations(plat, getattr(conf, 'dependency_index', None))
         if len(candidate_locations)==1:
             conf.msg('Automatically set %s' % self.as_option, candidate_locations[0])
             return candidate_locations[0]
@@ -346,6 +683,12 @@ class CSharpDirectory(CSharpDirectoryContainer):
         for subdir in self.directories:
             subdir.validate(conf)
 
+    def get_env_names(self):
+        names = [self.unique_id]
+        for subdir in self.directories:
+            names.extend(subdir.get_env_names())
+        return names
+
     def load_from_env(self, env):
         path = env.CSHARPDEPENDENCIES[self.unique_id]
         if path == INACTIVE_PATH:
@@ -399,16 +742,160 @@ class CSharpDirectory(CSharpDirectoryContainer):
         return paths
 
 
-def check_pkg_config(conf, pkg):
+# Name of the file, in the build directory, that holds the results of
+# previous pkg-config probes.
+PKG_CONFIG_CACHE_FILE = '.pkg-config-cache'
+# Key of the entry in that file for pkg-config's default search path.
+# Package names can't begin with a colon.
+PKG_CONFIG_DEFAULT_PATH_KEY = '::pc_path::'
+
+def run_pkg_config(*args):
+    """
+    Run pkg-config with args and return its output, or None if it fails
+    or isn't installed.
+    """
     try:
-        conf.start_msg('Consulting pkgconfig for '+pkg)
-        flags = check_output(['pkg-config', '--libs', pkg], stderr=open(os.devnull, 'w'))
-        conf.end_msg('ok')
-        return True
-    except:
+        return check_output(['pkg-config'] + list(args), stderr=open(os.devnull, 'w'))
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_pkg_config_libs(pkg):
+    """
+    Return the list of flags from "pkg-config --libs pkg", or None if
+    pkg-config doesn't know pkg.
+    """
+    output = run_pkg_config('--libs', pkg)
+    if output is None:
+        return None
+    return output.split()
+
+def find_pkg_config():
+    """
+    Return the path of the pkg-config executable on PATH, or None.
+    """
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        for name in ['pkg-config', 'pkg-config.exe']:
+            filename = path.join(directory, name)
+            if path.isfile(filename):
+                return filename
+    return None
+
+def get_pkg_config_default_path(cache_filename=None):
+    """
+    pkg-config's own default search path. This only changes when
+    pkg-config does, so if cache_filename is given it is kept there,
+    keyed by the location and mtime of the executable, and pkg-config
+    is only run when that changes.
+    """
+    executable = find_pkg_config()
+    if executable is None:
+        return []
+    key = (executable, get_mtime(executable))
+    cache = {}
+    if cache_filename is not None:
+        cache = read_pickle(cache_filename, {})
+        entry = cache.get(PKG_CONFIG_DEFAULT_PATH_KEY)
+        if entry is not None and entry[0] == key:
+            return entry[1]
+    output = run_pkg_config('--variable', 'pc_path', 'pkg-config')
+    if output is None:
+        return []
+    directories = [d for d in output.strip().split(os.pathsep) if d]
+    if cache_filename is not None:
+        cache[PKG_CONFIG_DEFAULT_PATH_KEY] = (key, directories)
+        write_pickle(cache_filename, cache)
+    return directories
+
+def get_pkg_config_search_path(cache_filename=None):
+    """
+    The directories pkg-config searches for .pc files: PKG_CONFIG_PATH,
+    followed by PKG_CONFIG_LIBDIR if it is set, or pkg-config's own
+    default path otherwise. See get_pkg_config_default_path for
+    cache_filename.
+    """
+    directories = []
+    for variable in ['PKG_CONFIG_PATH', 'PKG_CONFIG_LIBDIR']:
+        directories.extend(d for d in os.environ.get(variable, '').split(os.pathsep) if d)
+    if 'PKG_CONFIG_LIBDIR' not in os.environ:
+        directories.extend(get_pkg_config_default_path(cache_filename))
+    return directories
+
+def get_pc_file_mtimes(directories):
+    """
+    Return a sorted list of (filename, mtime) for every .pc file in
+    directories. Packages can require each other, so any of them can
+    affect the result of a probe.
+    """
+    mtimes = []
+    for directory in directories:
+        try:
+            names = os.listdir(directory)
+        except OSError:
+            continue
+        mtimes.extend(
+                (path.join(directory, name), get_mtime(path.join(directory, name)))
+                for name in names if name.endswith('.pc'))
+    return sorted(mtimes)
+
+@traced
+def probe_pkg_configs(pkgs, cache_filename=None, threads=8):
+    """
+    Run "pkg-config --libs" for each of pkgs concurrently. Returns a dict
+    mapping each one to its list of flags, or to None if pkg-config
+    doesn't know it. If cache_filename is given, results are reused from
+    and saved to it. Entries are keyed by package name, PKG_CONFIG_PATH and the mtimes
+    of the .pc files.
+    """
+    pkgs = sorted(set(pkgs))
+    if not pkgs:
+        return {}
+    environment = (os.environ.get('PKG_CONFIG_PATH'), os.environ.get('PKG_CONFIG_LIBDIR'))
+    pc_files = get_pc_file_mtimes(get_pkg_config_search_path(cache_filename))
+    cache = {}
+    if cache_filename is not None:
+        cache = read_pickle(cache_filename, {})
+    keys = dict((pkg, (pkg, environment, pc_files)) for pkg in pkgs)
+    results = {}
+    missing = []
+    for pkg in pkgs:
+        entry = cache.get(pkg)
+        if entry is not None and entry[0] == keys[pkg]:
+            results[pkg] = entry[1]
+        else:
+            missing.append(pkg)
+    if missing:
+        from multiprocessing.pool import ThreadPool
+        pool = ThreadPool(min(threads, len(missing)))
+        try:
+            flags = pool.map(get_pkg_config_libs, missing)
+        finally:
+            pool.close()
+            pool.join()
+        for pkg, pkg_flags in zip(missing, flags):
+            results[pkg] = pkg_flags
+            cache[pkg] = (keys[pkg], pkg_flags)
+        if cache_filename is not None:
+            write_pickle(cache_filename, cache)
+    return results
+
+@traced
+def check_pkg_config(conf, pkg):
+    """
+    Report whether pkg-config knows pkg. Returns its list of flags, or
+    None if it doesn't. Uses the results of CSharpDependencyCollection's
+    concurrent probes where they are available.
+    """
+    results = getattr(conf, 'pkg_config_results', {})
+    conf.start_msg('Consulting pkgconfig for '+pkg)
+    if pkg in results:
+        flags = results[pkg]
+    else:
+        flags = get_pkg_config_libs(pkg)
+    if flags is None:
         conf.end_msg('not found', 'YELLOW')
-        return False
-    
+    else:
+        conf.end_msg('ok')
+    return flags
 
 
 class CSharpPackage(CSharpDirectoryContainer):
@@ -440,26 +927,36 @@ class CSharpPackage(CSharpDirectoryContainer):
     def options(self, opt):
         for subdir in self.directories:
             subdir.options(opt)
+    def wants_pkg_config(self, conf):
+        if self.pkg is None:
+            return False
+        # If any of our directories are set using options, skip use of of pkgconfig.
+        options = []
+        for subdir in self.directories:
+            options.extend(subdir.get_options_recursively())
+        return not any([getattr(conf.options, option_to_field_name(o)) is not None for o in options])
     def configure(self, conf, defaults):
         if self.pkg is not None:
-            # If any of our directories are set using options, skip use of of pkgconfig.
-            options = []
-            for subdir in self.directories:
-                options.extend(subdir.get_options_recursively())
-            if any([getattr(conf.options, option_to_field_name(o)) is not None for o in options]):
-                self.use_pkg = False
-            elif check_pkg_config(conf, self.pkg):
-                self.use_pkg = True
-            else:
-                self.use_pkg = False
+            self.use_pkg = self.wants_pkg_config(conf) and check_pkg_config(conf, self.pkg) is not None
         if not self.use_pkg:
             for subdir in self.directories:
                 subdir.configure(conf, defaults)
         if conf.env.CSHARPDEPENDENCIES==[]:
             conf.env.CSHARPDEPENDENCIES = {}
         conf.env.CSHARPDEPENDENCIES[self.name] = (self.use_pkg, self.assembly_names)
+    def get_env_names(self):
+        """
+        Names of the entries this package and its directories store in
+        CSHARPDEPENDENCIES.
+        """
+        names = [self.name]
+        for subdir in self.directories:
+            names.extend(subdir.get_env_names())
+        return names
     def load_from_env(self, env):
-        self.use_pkg, self.assembly_names = env.CSHARPDEPENDENCIES[self.name]
+        # Builds configured for a while also stored the flags from
+        # pkg-config after these, but nothing used them.
+        self.use_pkg, self.assembly_names = env.CSHARPDEPENDENCIES[self.name][:2]
         if not self.use_pkg:
             for subdir in self.directories:
                 subdir.load_from_env(env)
@@ -1,34 +1,389 @@
 import zipfile
+import zlib
+import hashlib
+import pickle
+import struct
+import time
+import stat
 import os
 import shutil
 import tarfile
 import sys
+import itertools
+import functools
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from waflib import Node, Build, Utils, Options, Logs
+
+from wafmodules.tracing import traced, trace_method
+from wafmodules.archives import ParallelGzipWriter, DEFAULT_GZIP_LEVEL, DEFAULT_COMPRESSION_POLICY
 
 _ignorecase = sys.platform == 'win32'
 
+# Waf's own file-system searches, when tracing is enabled.
+for _method in ['ant_glob', 'find_resource', 'find_or_declare', 'find_node']:
+    trace_method(Node.Node, _method)
+
 def find_resource_or_fail(bld, root, path):
     node = root.find_resource(path)
     if node is None:
         bld.fatal("Could not find resource '%s' starting from root '%s'." % (path, root))
     return node
 
+@traced
+def copy_files(pairs, hardlink=False):
+    '''
+    Copy each (source, target) pair of filenames. A target that already
+    has its source's size and modification time, to the microsecond that
+    copying preserves, is taken to be up to date and left alone.
+    Otherwise it is replaced by a copy made with shutil.copy2, which keeps
+    the modification time so that the next run can skip it.
+
+    If hardlink, targets are hard links to their sources where possible.
+    Only ask for that when nothing edits the targets in place, since that
+    would also change the sources.
+    '''
+    link = getattr(os, 'link', None) if hardlink else None
+    for source, target in pairs:
+        source_st = os.stat(source)
+        try:
+            target_st = os.stat(target)
+        except OSError:
+            target_st = None
+        if target_st is not None:
+            if target_st.st_size == source_st.st_size and abs(target_st.st_mtime - source_st.st_mtime) < 1e-6:
+                continue
+            # Never write through an earlier hard link into its source.
+            os.remove(target)
+        if link is not None:
+            try:
+                link(source, target)
+                continue
+            except OSError:
+                # Across filesystems, or on a filesystem without hard
+                # links: copy this and the rest of the files.
+                link = None
+        shutil.copy2(source, target)
+
 def copy_task(task):
     if not (len(task.inputs) == len(task.outputs)):
         raise Exception("copy_task requires the same number of inputs and outputs.")
-    for source, target in zip(task.inputs, task.outputs):
-        shutil.copy2(source.abspath(), target.abspath())
+    copy_files(
+            ((source.abspath(), target.abspath()) for (source, target) in zip(task.inputs, task.outputs)),
+            getattr(task.generator, 'hardlink', False))
+
+# In deterministic mode every archive member gets this timestamp,
+# 1980-01-01 00:00:00 UTC, the earliest that a zip file can record.
+DETERMINISTIC_MTIME = 315532800
+DETERMINISTIC_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+
+CONTENT_HASH_SUFFIX = '.sha256'
+
+# Written next to each zip by incremental write_zip: the content hash of
+# every member, so that the next rebuild can find unchanged members.
+ZIP_INDEX_SUFFIX = '.members'
+ZIP_INDEX_VERSION = 2
+
+def is_deterministic(env):
+    '''
+    Whether archives should be reproducible, from DETERMINISTIC_ARCHIVES
+    in the environment if it was configured.
+    '''
+    return env.DETERMINISTIC_ARCHIVES is True
+
+def _normalised_mode(mode, isdir):
+    '''
+    Permissions for a deterministic archive member: everyone can read,
+    only the owner can write, and anyone can execute if anyone could.
+    '''
+    return 0755 if isdir or mode & 0111 else 0644
+
+def write_content_hash(filename, hash_filename):
+    '''
+    Write the SHA-256 of a file to a sidecar file, in the format of
+    sha256sum, so that publishing can tell whether the file has changed
+    without comparing the files themselves.
+    '''
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(block)
+    with open(hash_filename, 'w') as f:
+        f.write('%s  %s\n' % (digest.hexdigest(), os.path.basename(filename)))
+
+def _compress_file(job, reusable_keys=frozenset()):
+    '''
+    Read and compress one file for write_zip. job is (filename, level),
+    where level 0 means store. Returns (stat result, compressed data, CRC,
+    uncompressed size, key), with None for the data and key if filename
+    is a directory. The key is the SHA-1 of the data and the level: if
+    it's in reusable_keys the file isn't compressed at all, and the data
+    and CRC are None too. Runs in write_zip's thread pool: zlib, hashlib
+    and file reads release the GIL, so several files compress at once.
+    '''
+    filename, level = job
+    st = os.stat(filename)
+    if stat.S_ISDIR(st.st_mode):
+        return (st, None, 0, 0, None)
+    with open(filename, 'rb') as f:
+        data = f.read()
+    key = '%s:%s' % (hashlib.sha1(data).hexdigest(), level)
+    if key in reusable_keys:
+        return (st, None, None, len(data), key)
+    if level == 0:
+        compressed = data
+    else:
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+    return (st, compressed, zlib.crc32(data) & 0xffffffff, len(data), key)
 
+def _read_raw_member(fp, zinfo):
+    '''
+    The compressed data of a member of an open zip file, without
+    decompressing it.
+    '''
+    fp.seek(zinfo.header_offset)
+    fheader = struct.unpack(zipfile.structFileHeader, fp.read(zipfile.sizeFileHeader))
+    fp.seek(fheader[zipfile._FH_FILENAME_LENGTH] + fheader[zipfile._FH_EXTRA_FIELD_LENGTH], 1)
+    return fp.read(zinfo.compress_size)
+
+def _read_zip_index(zip_filename):
+    '''
+    The keys of the members of an existing zip file written by write_zip,
+    as {key: name in the zip} (see _compress_file), or {} if there is no
+    index or it doesn't describe the zip file as it is now.
+    '''
+    try:
+        with open(zip_filename + ZIP_INDEX_SUFFIX, 'rb') as f:
+            index = pickle.load(f)
+        st = os.stat(zip_filename)
+    except (IOError, OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    if index.get('version') != ZIP_INDEX_VERSION or index.get('zip') != (st.st_size, st.st_mtime):
+        return {}
+    return index['members']
+
+def _write_zip_index(zip_filename, members):
+    st = os.stat(zip_filename)
+    with open(zip_filename + ZIP_INDEX_SUFFIX, 'wb') as f:
+        pickle.dump({
+                'version' : ZIP_INDEX_VERSION,
+                'zip' : (st.st_size, st.st_mtime),
+                'members' : members,
+            }, f, pickle.HIGHEST_PROTOCOL)
+
+def _write_compressed_member(zf, arcname, st, compressed, crc, size, compress_type=zipfile.ZIP_DEFLATED, deterministic=False):
+    '''
+    Add an already compressed member to zf, with the same name handling
+    and header fields as ZipFile.write would use. If deterministic, the
+    timestamp, permissions and host system are fixed rather than taken
+    from the file and this machine.
+    '''
+    isdir = compressed is None
+    arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+    while arcname[0] in (os.sep, os.altsep):
+        arcname = arcname[1:]
+    if isdir:
+        arcname += '/'
+    if deterministic:
+        zinfo = zipfile.ZipInfo(arcname, DETERMINISTIC_DATE_TIME)
+        zinfo.create_system = 3
+        zinfo.external_attr = (stat.S_IFMT(st.st_mode) | _normalised_mode(st.st_mode, isdir)) << 16L
+    else:
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st.st_mode & 0xFFFF) << 16L
+    zinfo.flag_bits = 0x00
+    if isdir:
+        zinfo.compress_type = zipfile.ZIP_STORED
+        zinfo.file_size = zinfo.compress_size = zinfo.CRC = 0
+        zinfo.external_attr |= 0x10  # MS-DOS directory flag
+    else:
+        zinfo.compress_type = compress_type
+        zinfo.file_size = size
+        zinfo.compress_size = len(compressed)
+        zinfo.CRC = crc
+    zinfo.header_offset = zf.fp.tell()
+    zf._writecheck(zinfo)
+    zf._didModify = True
+    zip64 = zinfo.file_size > zipfile.ZIP64_LIMIT or zinfo.compress_size > zipfile.ZIP64_LIMIT
+    zf.fp.write(zinfo.FileHeader(zip64))
+    if not isdir:
+        zf.fp.write(compressed)
+    zf.filelist.append(zinfo)
+    zf.NameToInfo[zinfo.filename] = zinfo
+    return zinfo
+
+def write_zip(zip_filename, members, threads=None, deterministic=False, incremental=False, policy=None):
+    '''
+    Write a deflated zip file of members, a sequence of (filename, arcname).
+    The members are compressed concurrently by a pool of threads, but
+    written in the order given, so the result is the same standard zip
+    that ZipFile.write would produce. If deterministic, the members are
+    sorted by name and their metadata normalised, so that the same files
+    always give the same bytes. If a CompressionPolicy is given, it
+    chooses which members are stored rather than deflated, and at which
+    level.
+
+    If incremental, an index of the members' content hashes is kept next
+    to the zip file, and any member whose content is already in the
+    previous zip is copied from it still compressed, so that only new
+    and changed files are compressed again.
+    '''
+    members = list(members)
+    if deterministic:
+        members.sort(key=lambda (filename, arcname): arcname)
+    previous_index = _read_zip_index(zip_filename) if incremental else {}
+    previous_zf = None
+    if previous_index:
+        previous_zf = zipfile.ZipFile(zip_filename, 'r')
+    new_index = {}
+    # When the previous zip is being read, write the new one alongside it
+    # and replace it at the end.
+    output_filename = zip_filename + '.tmp' if previous_zf is not None else zip_filename
+    threads = threads or multiprocessing.cpu_count()
+    pool = ThreadPool(threads)
+    try:
+        zf = zipfile.ZipFile(output_filename, 'w', zipfile.ZIP_DEFLATED, allowZip64=True)
+        try:
+            compress = functools.partial(_compress_file, reusable_keys=frozenset(previous_index))
+            def write_member(arcname, level, result):
+                st, compressed, crc, size, key = result.get()
+                if key is not None and compressed is None:
+                    previous_zinfo = previous_zf.getinfo(previous_index[key])
+                    compressed = _read_raw_member(previous_zf.fp, previous_zinfo)
+                    crc = previous_zinfo.CRC
+                compress_type = zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED
+                zinfo = _write_compressed_member(zf, arcname, st, compressed, crc, size, compress_type, deterministic)
+                if key is not None:
+                    new_index[key] = zinfo.filename
+            pending = collections.deque()
+            for filename, arcname in members:
+                level = zlib.Z_DEFAULT_COMPRESSION if policy is None else policy.get_level(arcname, zlib.Z_DEFAULT_COMPRESSION)
+                pending.append((arcname, level, pool.apply_async(compress, ((filename, level),))))
+                # Keep a few members in hand for each thread, but no more,
+                # so that memory use doesn't grow with the size of the zip.
+                while len(pending) > 2 * threads:
+                    write_member(*pending.popleft())
+            while pending:
+                write_member(*pending.popleft())
+        finally:
+            zf.close()
+        if previous_zf is not None:
+            previous_zf.close()
+            previous_zf = None
+            if os.name == 'nt':
+                os.remove(zip_filename)
+            os.rename(output_filename, zip_filename)
+        if incremental:
+            _write_zip_index(zip_filename, new_index)
+    finally:
+        pool.close()
+        pool.join()
+        if previous_zf is not None:
+            previous_zf.close()
+        if output_filename != zip_filename and os.path.exists(output_filename):
+            os.remove(output_filename)
+
+def _with_compression_policy(tgen, policy):
+    '''
+    Give an archive task generator a CompressionPolicy. The policy is also
+    put in the generator's own environment, so that changing it rebuilds
+    the archive.
+    '''
+    tgen.compression_policy = policy
+    tgen.env.COMPRESSION_POLICY = repr(policy)
+    return tgen
+
+@traced
 def simpleziprule(task):
-    zf = zipfile.ZipFile(task.outputs[0].abspath(),'w',zipfile.ZIP_DEFLATED)
-    for inputnode, arcname in zip(task.inputs, task.generator.arcnames):
-        zf.write(inputnode.abspath(), arcname)
-    zf.close()
+    write_zip(
+            task.outputs[0].abspath(),
+            [(inputnode.abspath(), arcname) for (inputnode, arcname) in zip(task.inputs, task.generator.arcnames)],
+            deterministic=is_deterministic(task.env),
+            incremental=True,
+            policy=task.generator.compression_policy)
+    write_content_hash(task.outputs[0].abspath(), task.outputs[1].abspath())
+
+def get_tgz_level(env):
+    '''
+    The gzip compression level for tgz rules, from TGZ_LEVEL in the
+    environment if it was configured.
+    '''
+    level = env.TGZ_LEVEL
+    return DEFAULT_GZIP_LEVEL if level in ([], None) else int(level)
 
+def _normalise_tarinfo(tarinfo):
+    tarinfo.mtime = DETERMINISTIC_MTIME
+    tarinfo.mode = _normalised_mode(tarinfo.mode, tarinfo.isdir())
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    return tarinfo
+
+def write_tgz(tgz_filename, members, level=DEFAULT_GZIP_LEVEL, deterministic=False, policy=None):
+    '''
+    Write a gzipped tar file of members, a sequence of (filename, arcname),
+    gzip-compressed across all the cores. If deterministic, the members
+    are sorted by name and their timestamps, permissions and owners
+    normalised, as is the gzip header's timestamp. A directory is added
+    with its contents, in name order, either way.
+
+    Every file is written in full, even if it shares an inode with
+    another member (for instance a hard-linked copy), so that the
+    archive doesn't depend on which of them happens to come first.
+
+    The whole tar file is one gzip stream, so a CompressionPolicy can only
+    change the level as the stream goes along: each member is compressed
+    at the level the policy gives it, with the gzip writer starting a new
+    block whenever that changes.
+    '''
+    members = list(members)
+    if deterministic:
+        members.sort(key=lambda (filename, arcname): arcname)
+    gzfile = ParallelGzipWriter(tgz_filename, level, mtime=DETERMINISTIC_MTIME if deterministic else None)
+    def add(tarf, filename, arcname):
+        # gettarinfo turns a file with several links into a link to the
+        # first member it saw with the same inode, so forget them first.
+        tarf.inodes.clear()
+        tarinfo = tarf.gettarinfo(filename, arcname)
+        if deterministic:
+            _normalise_tarinfo(tarinfo)
+        if tarinfo.isreg():
+            if policy is not None:
+                gzfile.set_level(policy.get_level(arcname, level))
+            with open(filename, 'rb') as f:
+                tarf.addfile(tarinfo, f)
+        else:
+            tarf.addfile(tarinfo)
+        if tarinfo.isdir():
+            for name in sorted(os.listdir(filename)):
+                add(tarf, os.path.join(filename, name), arcname + '/' + name)
+    try:
+        tarf = tarfile.open(fileobj=gzfile, mode='w')
+        for filename, arcname in members:
+            add(tarf, filename, arcname)
+        tarf.close()
+    finally:
+        gzfile.close()
+
+@traced
 def simpletgzrule(task):
-    tarf = tarfile.open(task.outputs[0].abspath(),'w:gz')
-    for inputnode, arcname in zip(task.inputs, task.generator.arcnames):
-        tarf.add(inputnode.abspath(), arcname)
-    tarf.close()
+    write_tgz(
+            task.outputs[0].abspath(),
+            [(inputnode.abspath(), arcname) for (inputnode, arcname) in zip(task.inputs, task.generator.arcnames)],
+            get_tgz_level(task.env),
+            is_deterministic(task.env),
+            task.generator.compression_policy)
+    write_content_hash(task.outputs[0].abspath(), task.outputs[1].abspath())
+
+def _common_directory(paths):
+    '''The deepest directory containing all of paths, or '.' if none.'''
+    directories = [os.path.normpath(os.path.dirname(p)).split(os.sep) for p in paths]
+    common = os.path.commonprefix(directories)
+    if not common:
+        return '.'
+    return os.sep.join(common) or os.sep
 
 def _strip_prefix(path, prefix):
     result = os.path.relpath(path, prefix)
@@ -42,43 +397,137 @@ class FileTree(object):
     The files might all have absolute paths, or might all be relative.
     (There's no mechanism to enforce this, though.)
     Retains the order of the files.
+
+    Combining trees and transforming their paths don't copy anything:
+    the result just remembers its parts and the transform, so that a
+    long chain of + and prefix operations stays linear. The paths are
+    worked out the first time files is used, and then kept.
     '''
-    def __init__(self, files):
-        self.files = list(files)
+    def __init__(self, files=(), _parts=None, _transform=None):
+        if _parts is None:
+            self._files = list(files)
+        else:
+            self._files = None
+        self._parts = _parts
+        self._transform = _transform
+    @property
+    def files(self):
+        if self._files is None:
+            self._files = self._materialize()
+            self._parts = None
+            self._transform = None
+        return self._files
+    def _materialize(self):
+        # Walk the parts depth-first with an explicit stack, since a tree
+        # built by adding one part at a time can be very deep. transforms
+        # are the ones to apply to each path, innermost first.
+        result = []
+        stack = [(self, ())]
+        while stack:
+            tree, transforms = stack.pop()
+            if tree._files is not None:
+                if transforms:
+                    result.extend(_apply_transforms(transforms, f) for f in tree._files)
+                else:
+                    result.extend(tree._files)
+                continue
+            if tree._transform is not None:
+                transforms = (tree._transform,) + transforms
+            stack.extend((part, transforms) for part in reversed(tree._parts))
+        return result
     def __add__(self, other):
-        return FileTree(self.files + other.files)
+        return FileTree(_parts=(self, other))
+    def _transformed(self, transform):
+        if self._files is None and self._transform is not None:
+            # Compose with our own transform rather than nesting another level.
+            inner = self._transform
+            return FileTree(_parts=self._parts, _transform=lambda f: transform(inner(f)))
+        return FileTree(_parts=(self,), _transform=transform)
     def add_prefix(self, prefix):
-        return FileTree(os.path.join(prefix, f) for f in self.files)
+        return self._transformed(lambda f: os.path.join(prefix, f))
     def strip_prefix(self, prefix):
-        return FileTree(_strip_prefix(f, prefix) for f in self.files)
+        return self._transformed(lambda f: _strip_prefix(f, prefix))
     def flatten(self):
-        return FileTree(os.path.basename(f) for f in self.files)
+        return self._transformed(os.path.basename)
     def to_nodes(self, bld):
         return [_find_or_declare_node_by_abspath(bld,f) for f in self.files]
 
+def _apply_transforms(transforms, f):
+    for transform in transforms:
+        f = transform(f)
+    return f
+
 def _must_have_at_least_one(sequence):
     if len(sequence) < 1:
         raise ValueError("Expected a non-empty sequence.")
 
-def _find_or_declare_node_by_abspath(bld, abspath):
+class NodeResolver(object):
     '''
     Waf fights us tooth and nail to try to enforce its convoluted view of the file-system,
-    and falls to pieces any time it gets confused. This takes an absolute path and works
-    around waf's quirks to obtain the corresponding node.
-    If the node is in the build tree, it might not exist yet, and waf will do bizarre
+    and falls to pieces any time it gets confused. This takes absolute paths and works
+    around waf's quirks to obtain the corresponding nodes.
+    If a node is in the build tree, it might not exist yet, and waf will do bizarre
     things if we ask it to create the absolute path. If the node is outside of the build
     tree, we require it to exist now, or we will fail immediately.
+
+    The same paths are resolved many times while tasks are created, so each node is
+    remembered, and which of the two ways to look a file up is decided once for each
+    directory.
     '''
-    try:
-        build_path = os.path.relpath(abspath, bld.bldnode.abspath())
-        if os.path.split(build_path)[0]!='..':
-            return bld.bldnode.find_or_declare(build_path)
-    except ValueError:
-        # relpath raises ValueError if abspath is on a different drive from bldnode.
-        # Fall through and treat as non-build file.
-        pass
-    return find_resource_or_fail(bld, bld.root, abspath)
+    def __init__(self, bld):
+        self.bld = bld
+        self.bldpath = bld.bldnode.abspath()
+        self._nodes = {}
+        # Directory -> path components from the build directory, or None if files
+        # in it must be found from the root.
+        self._directories = {}
+    def _get_build_prefix(self, directory):
+        try:
+            return self._directories[directory]
+        except KeyError:
+            pass
+        try:
+            build_path = os.path.relpath(directory, self.bldpath)
+        except ValueError:
+            # relpath raises ValueError if the directory is on a different drive from
+            # bldnode. Treat it as non-build.
+            build_path = None
+        if build_path == '..':
+            build_path = None
+        prefix = None if build_path is None else [x for x in Utils.split_path(build_path) if x and x != '.']
+        self._directories[directory] = prefix
+        return prefix
+    def resolve(self, abspath):
+        try:
+            return self._nodes[abspath]
+        except KeyError:
+            pass
+        directory, name = os.path.split(os.path.abspath(abspath))
+        prefix = self._get_build_prefix(directory)
+        if prefix is not None:
+            node = self.bld.bldnode.find_or_declare(prefix + [name])
+        else:
+            node = find_resource_or_fail(self.bld, self.bld.root, abspath)
+        self._nodes[abspath] = node
+        return node
+
+def get_node_resolver(bld):
+    '''
+    The build's NodeResolver, created the first time it is needed.
+    '''
+    resolver = getattr(bld, 'node_resolver', None)
+    if resolver is None:
+        resolver = bld.node_resolver = NodeResolver(bld)
+    return resolver
+
+@traced
+def _find_or_declare_node_by_abspath(bld, abspath):
+    '''
+    The node for an absolute path, in the build tree or not. See NodeResolver.
+    '''
+    return get_node_resolver(bld).resolve(abspath)
 
+@traced
 def glob_files_src(bld, *globs):
     '''
     Search for files matching any of the given globs, relative to the source directory. (Note
@@ -89,6 +538,7 @@ def glob_files_src(bld, *globs):
     _must_have_at_least_one(globs)
     return combine_trees(FileTree(node.abspath() for node in bld.srcnode.ant_glob(g,remove=False)) for g in globs)
 
+@traced
 def glob_files_bld(bld, *globs):
     '''
     Search for files matching any of the given globs, relative to the build directory. The
@@ -98,6 +548,7 @@ def glob_files_bld(bld, *globs):
     _must_have_at_least_one(globs)
     return combine_trees(FileTree(node.abspath() for node in bld.bldnode.ant_glob(g,remove=False)) for g in globs)
 
+@traced
 def mk_virtual_tree(bld, rootpath, patterns):
     bldpath = bld.bldnode.abspath()
     toppath = bld.srcnode.abspath()
@@ -121,6 +572,7 @@ def _root_glob(root, glob):
         glob = glob[1:]
     return root.ant_glob(glob,ignorecase=_ignorecase, remove=False)
 
+@traced
 def glob_files_root(bld, *globs):
     '''
     Search for files matching any of the given globs, which should be absolute paths. The
@@ -158,7 +610,7 @@ def combine_trees(trees):
     '''
     Combine a sequence of FileTrees into one FileTree, retaining their order.
     '''
-    return sum(trees, FileTree([]))
+    return FileTree(_parts=tuple(trees))
 
 class FileTransfer(object):
     '''
@@ -196,33 +648,49 @@ class FileTransfer(object):
         return FileTransfer(
                 self.sourcetree,
                 self.targettree.flatten())
-    def create_zip_task(self, bld, target, name=None):
+    def create_zip_task(self, bld, target, name=None, policy=DEFAULT_COMPRESSION_POLICY):
         '''
         Create one task that combines all the source files into a zip-file, using the
-        targets as names inside the zip archive.
+        targets as names inside the zip archive. The CompressionPolicy chooses how
+        each file is compressed.
         '''
-        return bld(
+        return _with_compression_policy(bld(
                 rule=simpleziprule,
                 source=list(_find_or_declare_node_by_abspath(bld, f) for f in self.sourcetree.files),
                 arcnames=list(self.targettree.files),
-                target=target,
-                name=name)
-    def create_tgz_task(self, bld, target, name=None):
-        return bld(
+                vars=['DETERMINISTIC_ARCHIVES', 'COMPRESSION_POLICY'],
+                target=[target, target + CONTENT_HASH_SUFFIX],
+                name=name or target), policy)
+    def create_tgz_task(self, bld, target, name=None, policy=DEFAULT_COMPRESSION_POLICY):
+        return _with_compression_policy(bld(
                 rule=simpletgzrule,
                 source=list(_find_or_declare_node_by_abspath(bld, f) for f in self.sourcetree.files),
                 arcnames=list(self.targettree.files),
-                target=target,
-                name=name)
-    def create_copy_tasks(self, bld, name=None):
+                vars=['TGZ_LEVEL', 'DETERMINISTIC_ARCHIVES', 'COMPRESSION_POLICY'],
+                target=[target, target + CONTENT_HASH_SUFFIX],
+                name=name or target), policy)
+    def create_copy_tasks(self, bld, name=None, hardlink=False):
         '''
-        Create one task per file, copying from source locations to target locations.
+        Create one task that copies all the files from source locations to target
+        locations. If hardlink, the targets are hard links to the sources where
+        possible; see copy_files.
         Source locations should be absolute paths.
         Target locations should be relative to the build directory.
+        The task is named after the directory it copies into, unless a name is
+        given.
         '''
-        return [
-            bld(rule=copy_task, source=_find_or_declare_node_by_abspath(bld, s), target=t)
-            for s,t in zip(self.sourcetree.files, self.targettree.files)]
+        sources = self.sourcetree.files
+        if not sources:
+            return []
+        targets = list(self.targettree.files)
+        if name is None:
+            name = 'copy_files {0} ({1} files)'.format(_common_directory(targets), len(targets))
+        return [bld(
+                rule=copy_task,
+                source=[_find_or_declare_node_by_abspath(bld, s) for s in sources],
+                target=targets,
+                hardlink=hardlink,
+                name=name)]
     def install_files(self, bld):
         '''
         Copy the files at install-time.
@@ -231,16 +699,167 @@ class FileTransfer(object):
             bld.install_as(target, _find_or_declare_node_by_abspath(bld, source))
     def install_files_preserving_permissions(self, bld):
         '''
-        Copy the files at install-time.
+        Copy the files at install-time, keeping their permissions. The files
+        are copied by the build's ManifestInstaller once the build is
+        complete, rather than by one waf install task each.
         '''
         if not getattr(bld, 'is_install', False):
             return
+        installer = get_manifest_installer(bld)
+        root = _common_directory(self.targettree.files)
         for source, target in zip(self.sourcetree.files, self.targettree.files):
-            mode = os.stat(source).st_mode & 0o777
-            bld.install_as(target, bld.root.find_or_declare(source), chmod=mode)
+            installer.add(source, target, root)
+
+INSTALL_MANIFEST_FILE = '.install-manifest'
+INSTALL_MANIFEST_VERSION = 1
+
+def _hash_file(filename):
+    digest = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), ''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _get_install_path(bld, dest):
+    '''The same path that waf's install_as would install to.'''
+    dest = Utils.subst_vars(dest, bld.env).replace('/', os.sep)
+    if Options.options.destdir:
+        dest = os.path.join(Options.options.destdir, os.path.splitdrive(dest)[1].lstrip(os.sep))
+    return dest
+
+def _remove_empty_directories(directory, root):
+    '''
+    Remove directory and then each of its parents while they are empty,
+    stopping below root. Does nothing unless directory is inside root.
+    '''
+    root = os.path.normpath(root)
+    prefix = root.rstrip(os.sep) + os.sep
+    directory = os.path.normpath(directory)
+    while directory.startswith(prefix):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            return
+        directory = os.path.dirname(directory)
+
+class ManifestInstaller(object):
+    '''
+    Installs files at the end of "waf install", copying them in a pool of
+    threads. A manifest in the build directory records the content hash
+    and mode of every file installed, and a file is only copied again if
+    its hash or mode has changed since, or its installed copy is missing.
+    Hashes are only recalculated for sources whose size or modification
+    time has changed. "waf install --force" copies everything.
+
+    "waf uninstall" removes the files instead.
+    '''
+    def __init__(self, bld, threads=8):
+        self.bld = bld
+        self.threads = threads
+        self.files = []
+        self.manifest_filename = os.path.join(bld.bldnode.abspath(), INSTALL_MANIFEST_FILE)
+        bld.add_post_fun(self.run)
+    def add(self, source, dest, root=None):
+        '''
+        Install the file at absolute path source at dest, which may contain
+        ${VARIABLES} as for install_as. The file keeps its permissions.
+        Uninstalling removes the directories that become empty below root,
+        by default the directory containing dest, but never root itself.
+        '''
+        if root is None:
+            root = os.path.dirname(dest)
+        self.files.append((source, _get_install_path(self.bld, dest), _get_install_path(self.bld, root)))
+    def _read_manifest(self):
+        try:
+            with open(self.manifest_filename, 'rb') as f:
+                manifest = pickle.load(f)
+        except (IOError, EOFError, pickle.UnpicklingError):
+            return {}
+        if manifest.get('version') != INSTALL_MANIFEST_VERSION:
+            return {}
+        return manifest['files']
+    def _write_manifest(self, files):
+        with open(self.manifest_filename, 'wb') as f:
+            pickle.dump({'version' : INSTALL_MANIFEST_VERSION, 'files' : files}, f, pickle.HIGHEST_PROTOCOL)
+    def _install_file(self, job):
+        '''
+        Install one file if it has changed. job is (source, target,
+        previous manifest entry or None). Returns (new manifest entry,
+        whether it was copied). Runs in the thread pool.
+        '''
+        source, target, previous = job
+        st = os.stat(source)
+        mode = st.st_mode & 0777
+        if previous is not None and previous[:2] == (st.st_size, st.st_mtime):
+            digest = previous[2]
+        else:
+            digest = _hash_file(source)
+        entry = (st.st_size, st.st_mtime, digest, mode)
+        if (previous is not None and previous[2:] == entry[2:] and
+                not Options.options.force and os.path.isfile(target)):
+            return (entry, False)
+        try:
+            os.makedirs(os.path.dirname(target))
+        except OSError:
+            if not os.path.isdir(os.path.dirname(target)):
+                raise
+        try:
+            os.remove(target)
+        except OSError:
+            pass
+        shutil.copy2(source, target)
+        os.chmod(target, mode)
+        return (entry, True)
+    def run(self, bld):
+        if bld.is_install == Build.UNINSTALL:
+            self.uninstall()
+        else:
+            self.install()
+    def install(self):
+        manifest = self._read_manifest()
+        srcprefix = self.bld.srcnode.abspath() + os.sep
+        pool = ThreadPool(self.threads)
+        try:
+            jobs = [(source, target, manifest.get(target)) for (source, target, root) in self.files]
+            try:
+                for (source, target, previous), (entry, copied) in itertools.izip(jobs, pool.imap(self._install_file, jobs)):
+                    manifest[target] = entry
+                    if not self.bld.progress_bar:
+                        Logs.info('%s install %s (from %s)' % ('+' if copied else '-', target, source.replace(srcprefix, '')))
+            except (IOError, OSError), e:
+                self.bld.fatal('Could not install the file %r: %s' % (e.filename, e))
+            finally:
+                self._write_manifest(manifest)
+        finally:
+            pool.close()
+            pool.join()
+    def uninstall(self):
+        manifest = self._read_manifest()
+        for source, target, root in self.files:
+            if not self.bld.progress_bar:
+                Logs.info('- remove %s' % (target,))
+            manifest.pop(target, None)
+            try:
+                os.remove(target)
+            except OSError:
+                pass
+            _remove_empty_directories(os.path.dirname(target), root)
+        self._write_manifest(manifest)
+
+def get_manifest_installer(bld):
+    '''
+    The build's ManifestInstaller, created the first time it is needed.
+    '''
+    installer = getattr(bld, 'manifest_installer', None)
+    if installer is None:
+        installer = bld.manifest_installer = ManifestInstaller(bld)
+    return installer
 
 def combine_transfers(transfers):
     '''
     Combine a sequence of FileTransfers.
     '''
-    return sum(transfers, FileTransfer(FileTree([])))
+    transfers = list(transfers)
+    return FileTransfer(
+            combine_trees(t.sourcetree for t in transfers),
+            combine_trees(t.targettree for t in transfers))
@@ -0,0 +1,65 @@
+'''
+Helpers for the CI behaviour files in projectdata, which run from the top
+of the source tree, to skip publishing archives that haven't changed.
+Doesn't depend on waf.
+'''
+
+import os
+import shutil
+import tempfile
+import subprocess
+
+def read_content_hash(path):
+    '''
+    The hash in a sidecar file written by the waf archive rules, or None
+    if there isn't one.
+    '''
+    try:
+        with open(path) as f:
+            return f.read().split()[0]
+    except (IOError, IndexError):
+        return None
+
+def fetch_remote_content_hash(remotepath):
+    '''
+    Copy a sidecar hash file from user@host:path and return its hash, or
+    None if it can't be fetched, e.g. because nothing has been published
+    there yet. Says why when it can't.
+    '''
+    tempdir = tempfile.mkdtemp()
+    try:
+        localpath = os.path.join(tempdir, os.path.basename(remotepath))
+        try:
+            process = subprocess.Popen(['scp', '-q', remotepath, localpath], stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        except OSError as e:
+            print "Couldn't run scp to fetch {0}: {1}".format(remotepath, e)
+            return None
+        output, _ = process.communicate()
+        if process.returncode != 0:
+            print "Couldn't fetch {0}: scp exited with {1}: {2}".format(remotepath, process.returncode, output.strip())
+            return None
+        content_hash = read_content_hash(localpath)
+        if content_hash is None:
+            print "{0} doesn't contain a hash.".format(remotepath)
+        return content_hash
+    finally:
+        shutil.rmtree(tempdir)
+
+def is_unchanged_since_published(content_hash, remote_hash_path):
+    '''
+    True if content_hash, read from an archive's sidecar file with
+    read_content_hash, is the hash in remote_hash_path, at
+    user@host:path. If not, says why, so that the build log shows why
+    the archive was uploaded again.
+    '''
+    if content_hash is None:
+        print "The archive has no content hash, publishing anyway."
+        return False
+    remote_content_hash = fetch_remote_content_hash(remote_hash_path)
+    if remote_content_hash is None:
+        print "No published hash to compare with, publishing."
+        return False
+    if remote_content_hash != content_hash:
+        print "Hash {0} differs from the published {1}, publishing.".format(content_hash, remote_content_hash)
+        return False
+    return True
@@ -0,0 +1,128 @@
+'''
+Opt-in timing of configure and build.
+
+Set WAF_TRACE_DIR to a directory before running waf, e.g.
+
+    WAF_TRACE_DIR=trace ./waf configure build
+
+and each waf process writes two files there when it exits:
+    waf-<time>-<pid>.json - Chrome trace-event format, for chrome://tracing
+                            or https://ui.perfetto.dev
+    waf-<time>-<pid>.txt  - call counts and total times per function and
+                            phase, slowest first
+
+When WAF_TRACE_DIR isn't set, @traced returns the function unchanged, so
+there is no overhead.
+'''
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+import functools
+import inspect
+
+TRACE_DIR_VARIABLE = 'WAF_TRACE_DIR'
+
+_trace_dir = os.environ.get(TRACE_DIR_VARIABLE) or None
+if _trace_dir is not None:
+    # waf changes directory as it runs.
+    _trace_dir = os.path.abspath(_trace_dir)
+_start = time.time()
+# (name, category, start, duration, thread id) for each completed call.
+# Appending to a list is atomic, so worker threads can record freely.
+_events = []
+
+def _record(name, category, start, duration):
+    _events.append((name, category, start, duration, threading.current_thread().ident))
+
+def traced(func=None, category='function', name=None):
+    '''
+    Decorator that records every call of the function, by default named
+    by its module and function name. Can be used as @traced or
+    @traced(category='...', name='...').
+    '''
+    if func is None:
+        return lambda f: traced(f, category, name)
+    if _trace_dir is None:
+        return func
+    if name is None:
+        name = '%s.%s' % (func.__module__.split('.')[-1], func.__name__)
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _record(name, category, start, time.time() - start)
+    # Waf hashes a rule function's source into its tasks' signatures
+    # (see waflib.Utils.h_fun). Give it the wrapped function's source, so
+    # that turning tracing on or off doesn't cause a rebuild.
+    try:
+        wrapper.code = getattr(func, 'code', None) or inspect.getsource(func)
+    except (IOError, TypeError):
+        pass
+    return wrapper
+
+def trace_method(cls, method_name, category='waf'):
+    '''
+    Wrap a method of a class we don't own, such as waf's Node.ant_glob,
+    so that its calls are recorded too. Does nothing unless tracing is
+    enabled.
+    '''
+    if _trace_dir is None:
+        return
+    method = getattr(cls, method_name)
+    if getattr(method, '_traced', False):
+        return
+    wrapper = traced(method, category, '%s.%s' % (cls.__name__, method_name))
+    wrapper._traced = True
+    setattr(cls, method_name, wrapper)
+
+def trace_to_string(events):
+    pid = os.getpid()
+    trace_events = [
+        {
+            'name' : name,
+            'cat' : category,
+            'ph' : 'X',
+            'ts' : int((start - _start) * 1e6),
+            'dur' : int(duration * 1e6),
+            'pid' : pid,
+            'tid' : tid,
+        }
+        for (name, category, start, duration, tid) in events]
+    return json.dumps({'traceEvents' : trace_events, 'displayTimeUnit' : 'ms'}) + "\n"
+
+def summary_to_string(events):
+    '''
+    One line per name: total time, call count and mean time, slowest
+    total first. Times of nested calls are also included in their
+    callers' totals.
+    '''
+    totals = {}
+    for (name, category, start, duration, tid) in events:
+        total, count, cat = totals.get(name, (0.0, 0, category))
+        totals[name] = (total + duration, count + 1, cat)
+    lines = ["%10s %8s %10s  %-9s %s\n" % ("total ms", "calls", "mean ms", "category", "name")]
+    for name, (total, count, category) in sorted(totals.items(), key=lambda item: -item[1][0]):
+        lines.append("%10.1f %8d %10.3f  %-9s %s\n" % (total * 1000, count, total * 1000 / count, category, name))
+    return "".join(lines)
+
+def write_trace():
+    if _trace_dir is None or not _events:
+        return
+    if not os.path.isdir(_trace_dir):
+        os.makedirs(_trace_dir)
+    events = list(_events)
+    basename = os.path.join(_trace_dir, 'waf-%s-%s' % (time.strftime('%Y%m%d-%H%M%S', time.localtime(_start)), os.getpid()))
+    with open(basename + '.json', 'w') as f:
+        f.write(trace_to_string(events))
+    with open(basename + '.txt', 'w') as f:
+        f.write(summary_to_string(events))
+    sys.stderr.write("Timing trace written to %s.json\n" % (basename,))
+
+if _trace_dir is not None:
+    atexit.register(write_trace)
@@ -0,0 +1,47 @@
+import os
+import sys
+
+from waflib import Task
+from waflib.TaskGen import extension
+
+# uscpd2xml.py lives with the other uSCPD tools rather than in wafmodules.
+_uscpd_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src', 'Uscpd')
+if _uscpd_dir not in sys.path:
+    sys.path.insert(0, _uscpd_dir)
+import uscpd2xml
+
+# Task generators that use uscpd2xml_task should add this to their deps,
+# so that changes to the converter cause the XML to be regenerated.
+USCPD2XML_SCRIPT = 'src/Uscpd/uscpd2xml.py'
+
+def _convert_nodes(inputs, outputs):
+    cache = uscpd2xml.cache_from_environment()
+    for source, target in zip(inputs, outputs):
+        try:
+            uscpd2xml.convert(source.abspath(), target.abspath(), cache=cache)
+        except uscpd2xml.UscpdSyntaxError, e:
+            raise Exception("%s: %s" % (source.abspath(), e))
+
+def uscpd2xml_task(task):
+    '''
+    Convert each uSCPD input to the corresponding SCPD XML output,
+    inside the waf process.
+    '''
+    if not (len(task.inputs) == len(task.outputs)):
+        raise Exception("uscpd2xml_task requires the same number of inputs and outputs.")
+    _convert_nodes(task.inputs, task.outputs)
+
+class uscpd(Task.Task):
+    color = 'BLUE'
+    ext_in = ['.uscpd']
+    ext_out = ['.xml']
+    def run(self):
+        _convert_nodes(self.inputs, self.outputs)
+
+@extension('.uscpd')
+def process_uscpd(self, node):
+    '''
+    Any .uscpd file given as a source is converted to a .xml file of the
+    same name in the build directory.
+    '''
+    self.create_task('uscpd', node, node.change_ext('.xml'))